@@ -0,0 +1,438 @@
+"""Офлайн бенчмарк загрузки плейлистов, поиска треков и переходов между треками.
+
+YoutubeDL, spotipy.Spotify, FFmpegOpusAudio и голосовой клиент Discord подменяются
+локальными заглушками с настраиваемой задержкой и долей ошибок, поэтому прогон не
+ходит в сеть и не требует токенов. Результаты сохраняются в JSON и сравниваются
+с предыдущим прогоном.
+
+    python benchmark.py --sizes 100 1000 10000 --latency 0.01 --failure-rate 0.02
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+import tracemalloc
+import types
+from datetime import datetime, timezone
+from pathlib import Path
+
+import main
+from main import FRAMES_PER_SECOND
+
+
+class BenchSettings:
+    latency = 0.01
+    failure_rate = 0.0
+    page_size = 100
+    track_seconds = 0.5
+
+
+class FakeYoutubeDL:
+    """Заглушка YoutubeDL: отвечает как yt-dlp, но без сети"""
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def _delay(self):
+        time.sleep(random.uniform(0.5, 1.5) * BenchSettings.latency)
+
+    def _failed(self):
+        return random.random() < BenchSettings.failure_rate
+
+    @staticmethod
+    def _video(video_id, title=None):
+        return {
+            'id': video_id,
+            'title': title or f"Трек {video_id}",
+            'url': f"https://www.youtube.com/watch?v={video_id}",
+            'webpage_url': f"https://www.youtube.com/watch?v={video_id}",
+            'duration': BenchSettings.track_seconds,
+        }
+
+    def extract_info(self, query, download=False, process=True, **kwargs):
+        if query.startswith('ytsearch'):
+            self._delay()
+            if self._failed():
+                return None
+            prefix, _, text = query.partition(':')
+            count = int(prefix[len('ytsearch'):] or 1)
+            video_id = f"s{abs(hash(text)) % 10 ** 8}"
+            return {
+                '_type': 'playlist',
+                'entries': [self._video(f"{video_id}-{i}", text) for i in range(count)]
+            }
+
+        if query.startswith('https://bench.local/playlist/'):
+            size = int(query.rsplit('/', 1)[1])
+
+            def entries():
+                for i in range(size):
+                    # Новая страница плейлиста стоит одного запроса
+                    if i % BenchSettings.page_size == 0:
+                        self._delay()
+                    yield dict(self._video(f"p{i}"), _type='url')
+
+            return {'_type': 'playlist', 'entries': entries() if not process else list(entries())}
+
+        # Страница трека: разрешение формата
+        self._delay()
+        if self._failed():
+            return None
+        expire = int(time.time()) + 6 * 3600
+        return {
+            'title': query,
+            'url': f"https://bench.local/stream?expire={expire}&src={query}",
+            'acodec': 'opus',
+            'ext': 'webm',
+            'duration': BenchSettings.track_seconds,
+        }
+
+    def close(self):
+        pass
+
+
+class FakeSpotify:
+    """Заглушка spotipy.Spotify с постраничной выдачей"""
+
+    def __init__(self, size):
+        self.size = size
+
+    def _page(self, offset, limit=100):
+        time.sleep(BenchSettings.latency)
+        items = [{
+            'track': {
+                'id': f"sp{i}",
+                'name': f"Песня {i}",
+                'artists': [{'name': f"Исполнитель {i % 50}"}],
+                'duration_ms': 180000,
+            }
+        } for i in range(offset, min(offset + limit, self.size))]
+        following = offset + limit
+        return {
+            'items': items,
+            'total': self.size,
+            'offset': offset,
+            'next': f"offset={following}" if following < self.size else None,
+        }
+
+    def playlist_tracks(self, playlist_id, fields=None, limit=100, offset=0, **kwargs):
+        return self._page(offset, limit)
+
+    def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, **kwargs):
+        return self._page(offset, limit)
+
+    def next(self, result):
+        return self._page(result['offset'] + len(result['items'])) if result['next'] else None
+
+
+class FakeAudioSource:
+    """Заглушка FFmpegOpusAudio: после задержки "подключения" отдает кадры трека"""
+
+    def __init__(self, source, **kwargs):
+        self.source = source
+        self.kwargs = kwargs
+        self.frames_left = int(BenchSettings.track_seconds * FRAMES_PER_SECOND)
+        self.connected = False
+
+    def is_opus(self):
+        return True
+
+    def read(self):
+        if not self.connected:
+            self.connected = True
+            time.sleep(BenchSettings.latency)
+        if self.frames_left <= 0:
+            return b''
+        self.frames_left -= 1
+        return b'\xf8\xff\xfe'
+
+    def cleanup(self):
+        pass
+
+
+class FakeVoiceClient:
+    """Заглушка голосового клиента: читает кадры источника в темпе 20 мс, как AudioPlayer"""
+
+    def __init__(self):
+        self.first_frame_at = None
+        self.first_play = asyncio.Event()
+        # Самая долгая задержка кадра сверх 20 мс: тишина на переходе между треками
+        self.max_stall = 0.0
+        self._last_frame_at = None
+        self._loop = asyncio.get_running_loop()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def is_connected(self):
+        return True
+
+    def is_playing(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def play(self, source, after=None):
+        self._stopped = stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(source, after, stopped), daemon=True)
+        self._thread.start()
+
+    def _run(self, source, after, stopped):
+        frame = 1 / FRAMES_PER_SECOND
+        while not stopped.is_set():
+            data = source.read()
+            if not data:
+                break
+            now = time.perf_counter()
+            if self._last_frame_at is None:
+                self.first_frame_at = now
+                self._loop.call_soon_threadsafe(self.first_play.set)
+            else:
+                self.max_stall = max(self.max_stall, now - self._last_frame_at - frame)
+            self._last_frame_at = now
+            stopped.wait(frame)
+        source.cleanup()
+        if after and not self._loop.is_closed():
+            after(None)
+
+    def stop(self):
+        self._stopped.set()
+
+    async def disconnect(self, force=False):
+        self._stopped.set()
+
+
+def make_cog(base_config):
+    loop = asyncio.get_running_loop()
+    bot = types.SimpleNamespace(loop=loop, user=None, get_channel=lambda _: None)
+    return main.MusicCog(bot, main.BotConfig(base_config))
+
+
+def load_base_config(path):
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    bot_settings = config['BotSettings']
+    bot_settings['CacheEnabled'] = False
+    bot_settings['StreamCachePersist'] = False
+    bot_settings['AudioCacheEnabled'] = False
+    bot_settings['SpotifyClientId'] = ''
+    bot_settings['SpotifyClientSecret'] = ''
+    return config
+
+
+async def bench_import(base_config, kind, size, measure_memory):
+    """Время до первого трека и полное время импорта плейлиста"""
+    cog = make_cog(base_config)
+    player = cog.get_player(0)
+    if kind == 'spotify':
+        cog.spotify = FakeSpotify(size)
+        url = f"https://open.spotify.com/playlist/bench{size}"
+    else:
+        url = f"https://bench.local/playlist/{size}"
+
+    if measure_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    ok = await player._start_loading(url, None)
+    first_track = time.perf_counter() - started
+    if player._load_task:
+        await player._load_task
+    total = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] if measure_memory else None
+    if measure_memory:
+        tracemalloc.stop()
+
+    result = {
+        'ok': bool(ok),
+        'tracks': len(player.full_playlist),
+        'first_track_s': round(first_track, 4),
+        'import_s': round(total, 4),
+        'peak_memory_bytes': peak,
+    }
+    cog.cog_unload()
+    return result
+
+
+def retained_bytes(build):
+    """Сколько памяти остается занято результатом build() после построения"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    value = build()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del value
+    return retained
+
+
+def bench_queue_memory(size):
+    """Память очереди на size треков: прежний список словарей против TrackQueue из кеша"""
+    rows = [
+        {
+            'url': f"https://www.youtube.com/watch?v=bench{i:07d}",
+            'title': f"Исполнитель {i % 500} - Длинное название трека номер {i}",
+            'original_url': f"https://www.youtube.com/watch?v=bench{i:07d}",
+            'duration': 180 + i % 120,
+        }
+        for i in range(size)
+    ]
+    # Оба варианта читаются из JSON кеша, как при загрузке плейлиста
+    legacy_json = json.dumps(rows)
+    current_json = json.dumps([{key: row[key] for key in ('url', 'title', 'duration')} for row in rows])
+
+    def load_queue():
+        return main.TrackQueue(map(main.Track.from_dict, json.loads(current_json)))
+
+    # Прогрев: таблица интернированных строк растет один раз и в замер не попадает
+    load_queue()
+    dicts = retained_bytes(lambda: json.loads(legacy_json))
+    queue = retained_bytes(load_queue)
+    first = load_queue()
+    permutation = retained_bytes(first.shuffle)
+    # Тот же плейлист во второй сессии, пока первая жива: строки берутся из интернированных
+    second_session = retained_bytes(load_queue)
+    del first
+    return {
+        'tracks': size,
+        'dicts_bytes_per_track': round(dicts / size, 1),
+        'queue_bytes_per_track': round(queue / size, 1),
+        'permutation_bytes_per_track': round(permutation / size, 1),
+        'queue_second_session_bytes_per_track': round(second_session / size, 1),
+    }
+
+
+def gap_totals():
+    """(число, сумма) замеров паузы между треками, которые пишет сам плеер"""
+    count, mean = main.metrics.histogram_summary('track_gap_seconds').get((), (0, 0.0))
+    return count, count * mean
+
+
+async def bench_playback(base_config, size, transitions, gapless):
+    """Время до первого звука и паузы между треками при естественной смене"""
+    base_config = json.loads(json.dumps(base_config))
+    base_config['BotSettings']['GaplessPlayback'] = gapless
+    cog = make_cog(base_config)
+    player = cog.get_player(0)
+    voice = player.voice_client = FakeVoiceClient()
+    gaps_before, gap_sum_before = gap_totals()
+
+    started = time.perf_counter()
+    await player._start_loading(f"https://bench.local/playlist/{size}", None)
+    await player.play_next()
+    await voice.first_play.wait()
+    time_to_first_audio = voice.first_frame_at - started
+
+    deadline = time.perf_counter() + (transitions + 2) * (BenchSettings.track_seconds + 5)
+    while gap_totals()[0] - gaps_before < transitions and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+
+    gaps, gap_sum = gap_totals()
+    gaps, gap_sum = gaps - gaps_before, gap_sum - gap_sum_before
+    player.clear()
+    await voice.disconnect()
+    if player._load_task:
+        await asyncio.gather(player._load_task, return_exceptions=True)
+    cog.cog_unload()
+    return {
+        'time_to_first_audio_s': round(time_to_first_audio, 4),
+        'transitions': gaps,
+        'gap_mean_s': round(gap_sum / gaps, 4) if gaps else None,
+        'stall_max_s': round(voice.max_stall, 4),
+    }
+
+
+async def run(args, base_config):
+    results = {
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'settings': {
+            'latency': args.latency,
+            'failure_rate': args.failure_rate,
+            'track_seconds': args.track_seconds,
+            'sizes': args.sizes,
+        },
+        'import': {},
+        'playback': {},
+        'queue_memory': {},
+    }
+    for kind in ('youtube', 'spotify'):
+        for size in args.sizes:
+            print(f"Импорт {kind} на {size} треков...")
+            results['import'][f"{kind}_{size}"] = await bench_import(base_config, kind, size, not args.no_memory)
+
+    if not args.no_memory:
+        print(f"Память очереди на {args.queue_size} треков...")
+        results['queue_memory'] = bench_queue_memory(args.queue_size)
+
+    size = max(args.sizes[0], args.transitions + 2)
+    for mode, gapless in (('gapless', True), ('restart', False)):
+        print(f"Воспроизведение ({mode}), {args.transitions} переходов...")
+        results['playback'][mode] = await bench_playback(base_config, size, args.transitions, gapless)
+    return results
+
+
+def flatten(data, prefix=''):
+    flat = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(current, previous):
+    """Печатает изменение каждой метрики относительно прошлого прогона"""
+    sections = ('import', 'playback', 'queue_memory')
+    old = flatten({name: previous.get(name, {}) for name in sections})
+    new = flatten({name: current[name] for name in sections})
+    print(f"\nСравнение с прогоном {previous.get('started_at')}:")
+    for name, value in new.items():
+        if name in old and old[name]:
+            change = (value - old[name]) / old[name] * 100
+            print(f"  {name}: {old[name]} -> {value} ({change:+.1f}%)")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Офлайн бенчмарк MusicCog")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--latency', type=float, default=0.01, help="Задержка одного запроса, сек")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="Доля неудачных извлечений")
+    parser.add_argument('--track-seconds', type=float, default=0.5, help="Длительность трека в прогоне, сек")
+    parser.add_argument('--transitions', type=int, default=5)
+    parser.add_argument('--no-memory', action='store_true', help="Не измерять пик памяти (tracemalloc)")
+    parser.add_argument('--queue-size', type=int, default=10000, help="Размер очереди для замера памяти")
+    parser.add_argument('--results-dir', default='bench_results')
+    parser.add_argument('--compare', help="JSON прошлого прогона; по умолчанию последний в results-dir")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    BenchSettings.latency = args.latency
+    BenchSettings.failure_rate = args.failure_rate
+    BenchSettings.track_seconds = args.track_seconds
+    logging.getLogger().setLevel(logging.WARNING)
+
+    # Подменяем внешние зависимости заглушками
+    main.YoutubeDL = FakeYoutubeDL
+    main.discord.FFmpegOpusAudio = FakeAudioSource
+
+    results = asyncio.run(run(args, load_base_config(args.config)))
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+    results_dir = Path(args.results_dir)
+    previous_runs = sorted(results_dir.glob('*.json'))
+    previous_path = Path(args.compare) if args.compare else (previous_runs[-1] if previous_runs else None)
+    if previous_path and previous_path.exists():
+        with open(previous_path, encoding='utf-8') as f:
+            compare(results, json.load(f))
+
+    results_dir.mkdir(parents=True, exist_ok=True)
+    out_file = results_dir / f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.json"
+    with open(out_file, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты сохранены: {out_file}")
+
+
+if __name__ == "__main__":
+    main_cli()
\ No newline at end of file
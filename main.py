@@ -1,19 +1,31 @@
 import json
 import asyncio
 import logging
+import logging.handlers
+import math
 import os
 import sys
 import io
 import random
 import re
+import shlex
+import time
+import threading
+import atexit
+import copy
+import multiprocessing
+import queue
+from array import array
+from collections import OrderedDict, deque
+from contextlib import aclosing, contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qs
 import discord
 from discord import app_commands
 from discord.ext import commands
-from yt_dlp import YoutubeDL
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
 import hashlib
+import sqlite3
 from pathlib import Path
 
 
@@ -35,26 +47,663 @@ class UnicodeStreamHandler(logging.StreamHandler):
             self.handleError(record)
 
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log', encoding='utf-8'),
-        UnicodeStreamHandler()
-    ]
+class JsonFormatter(logging.Formatter):
+    """Одна JSON запись на строку: время, уровень, сообщение и структурные поля"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Кладет запись в очередь, не склеивая трассировку с текстом сообщения"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_log_listener = None
+
+
+def setup_logging(log_file='bot.log', max_bytes=10 * 1024 * 1024, backup_count=5):
+    """Логи идут через очередь: запись на диск и в консоль делает отдельный поток"""
+    _stop_logging()
+    global _log_listener
+
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', errors='replace'
+    )
+    file_handler.setFormatter(JsonFormatter())
+    stream_handler = UnicodeStreamHandler()
+    stream_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+
+    # Неограниченная очередь: поток событий никогда не ждет диск
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(LogQueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+
+    _log_listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler)
+    _log_listener.start()
+
+
+def _stop_logging():
+    """Дописывает очередь и закрывает файлы логов"""
+    global _log_listener
+    if _log_listener:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+
+
+# Настройка логирования; процессы извлечения (spawn) импортируют модуль заново и в файл не пишут
+if multiprocessing.parent_process() is None:
+    setup_logging()
+    atexit.register(_stop_logging)
+
+
+def safe_log_info(message, exc_info=False, **fields):
+    """Логирование через очередь; именованные аргументы попадают в JSON запись как поля"""
+    logging.info(str(message), exc_info=exc_info, extra={'fields': fields} if fields else None)
+
+
+class Metrics:
+    """Счетчики и гистограммы горячих путей, отдаются в текстовом формате Prometheus"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    hist['buckets'][i] += 1
+            hist['sum'] += seconds
+            hist['count'] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def gauge(self, name, callback):
+        """Регистрирует вычисляемое значение: callback возвращает {labels_tuple: value}"""
+        self._gauges[name] = callback
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: dict(v, buckets=list(v['buckets'])) for k, v in self._histograms.items()}
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (n, labels), value in counters.items():
+                if n == name:
+                    lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (n, labels), hist in histograms.items():
+                if n != name:
+                    continue
+                for bound, count in zip(self.BUCKETS, hist['buckets']):
+                    lines.append(f"{name}_bucket{self._format_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {hist['count']}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {hist['sum']:.6f}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {hist['count']}")
+        for name, callback in sorted(self._gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            try:
+                values = callback()
+            except Exception:
+                continue
+            for labels, value in values.items():
+                lines.append(f"{name}{self._format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def histogram_summary(self, name):
+        """{labels: (count, среднее)} для команды /stats"""
+        with self._lock:
+            return {
+                labels: (hist['count'], hist['sum'] / hist['count'])
+                for (n, labels), hist in self._histograms.items() if n == name and hist['count']
+            }
+
+    async def serve(self, host, port):
+        """Минимальный HTTP сервер, отдающий метрики на любой GET"""
+        async def handle(reader, writer):
+            try:
+                while (await reader.readline()).strip():
+                    pass
+                body = self.render().encode('utf-8')
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                    b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                    b"Connection: close\r\n\r\n" + body
+                )
+                await writer.drain()
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+
+metrics = Metrics()
+
+
+# discord.py отдает звук кадрами по 20 мс
+FRAMES_PER_SECOND = 50
+
+# Сколько треков из кеша читать до старта воспроизведения, остальные дочитываются в фоне
+CACHE_FIRST_PAGE = 50
+
+
+def mix_pcm(outgoing, incoming, weight):
+    """Смешивает два кадра 16-бит PCM; weight - доля входящего трека от 0 до 1"""
+    a = array('h', outgoing)
+    b = array('h', incoming)
+    if len(b) < len(a):
+        b.extend([0] * (len(a) - len(b)))
+    return array('h', (
+        max(-32768, min(32767, int(x * (1 - weight) + y * weight))) for x, y in zip(a, b)
+    )).tobytes()
+
+
+class PrebufferedSource(discord.AudioSource):
+    """Источник ffmpeg с фоновым чтением кадров в ограниченный буфер.
+
+    Поток-наполнитель держит впереди до capacity кадров по 20 мс, поэтому ffmpeg
+    успевает подключиться и прогреться до того, как кадры понадобятся плееру.
+    """
+
+    # Допуск на округление длительности: раньше конца на столько - обрыв потока
+    EARLY_END_TOLERANCE = 5
+
+    def __init__(self, source, track, stream, capacity, on_first_packet=None, offset=0):
+        self.source = source
+        self.track = track
+        self.stream = stream
+        # С какой секунды трека запущен ffmpeg (-ss при возобновлении)
+        self.offset = offset
+        self.capacity = max(1, capacity)
+        self.on_first_packet = on_first_packet
+        self.spawned_at = time.perf_counter()
+        # Момент начала воспроизведения (monotonic), выставляет GuildPlayer
+        self.started_at = time.monotonic()
+        self.frames_buffered = 0
+        self.frames_played = 0
+        self._frames = deque()
+        self._cond = threading.Condition()
+        self._eof = False
+        self._closed = False
+        # ffmpeg завершился сам, а не был закрыт плеером
+        self._source_ended = False
+        threading.Thread(target=self._fill, name='ffmpeg-prebuffer', daemon=True).start()
+
+    def _fill(self):
+        try:
+            while True:
+                data = self.source.read()
+                with self._cond:
+                    if self._closed or not data:
+                        break
+                    if not self.frames_buffered:
+                        metrics.observe('ffmpeg_first_packet_seconds', time.perf_counter() - self.spawned_at)
+                    self._frames.append(data)
+                    self.frames_buffered += 1
+                    self._cond.notify_all()
+                    while len(self._frames) >= self.capacity and not self._closed:
+                        self._cond.wait()
+        except Exception as e:
+            safe_log_info(f"Ошибка чтения ffmpeg: {e}")
+        finally:
+            with self._cond:
+                self._eof = True
+                self._source_ended = not self._closed
+                self._cond.notify_all()
+
+    @property
+    def failed(self):
+        """ffmpeg завершился, не отдав ни одного кадра (обычно протухшая ссылка)"""
+        return self._eof and not self.frames_buffered
+
+    @property
+    def position(self):
+        """Сколько секунд трека уже отдано плееру"""
+        return self.offset + self.frames_played / FRAMES_PER_SECOND
+
+    @property
+    def ended_early(self):
+        """ffmpeg дочитал поток, хотя до конца трека далеко: оборвалось соединение или протухла ссылка.
+
+        Сравнивается с длительностью извлеченного медиа, а не с метаданными плейлиста:
+        у треков из Spotify найденное видео бывает заметно короче.
+        """
+        with self._cond:
+            drained = self._source_ended and not self._frames
+        duration = self.stream.get('duration')
+        return drained and bool(duration) and self.position < duration - self.EARLY_END_TOLERANCE
+
+    def frames_left(self):
+        """Сколько кадров осталось до конца трека, если ffmpeg уже дочитал его; иначе None"""
+        with self._cond:
+            return len(self._frames) if self._eof else None
+
+    def _pop(self):
+        data = self._frames.popleft()
+        self._cond.notify_all()
+        return data
+
+    def read(self):
+        with self._cond:
+            while not self._frames and not self._eof and not self._closed:
+                self._cond.wait()
+            data = self._pop() if self._frames else b''
+        if data:
+            if not self.frames_played and self.on_first_packet:
+                self.on_first_packet(time.perf_counter())
+            self.frames_played += 1
+        return data
+
+    def read_nowait(self):
+        """Кадр из буфера без ожидания ffmpeg; пустой, если буфер пуст"""
+        with self._cond:
+            data = self._pop() if self._frames else b''
+        if data:
+            self.frames_played += 1
+        return data
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self.source.cleanup()
+
+
+class GaplessSource(discord.AudioSource):
+    """Непрерывный поток для голосового клиента: по концу трека сразу переходит на заранее
+    открытый следующий, не останавливая плеер discord.py"""
+
+    def __init__(self, first, on_advance, crossfade_frames=0):
+        self.current = first
+        self.on_advance = on_advance
+        self.crossfade_frames = crossfade_frames
+        self._next = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def set_next(self, source):
+        """Подготовленный источник следующего трека; после закрытия потока сразу освобождается"""
+        with self._lock:
+            if self._closed:
+                discard = source
+            else:
+                discard, self._next = self._next, source
+                if discard is source:
+                    discard = None
+        if discard is not None:
+            discard.cleanup()
+
+    def _take_next(self):
+        with self._lock:
+            source, self._next = self._next, None
+        return source
+
+    def read(self):
+        data = self.current.read()
+        if data and self.crossfade_frames and not self.current.is_opus():
+            data = self._crossfade(data)
+        if data:
+            return data
+
+        if self.current.ended_early:
+            # Трек оборвался: следующий не включаем, плеер остановится и возобновит этот же трек
+            return b''
+        following = self._take_next()
+        if following is None:
+            return b''
+        finished, self.current = self.current, following
+        finished.cleanup()
+        self.on_advance(finished, following)
+        # Пустой кадр (ffmpeg следующего трека упал) завершит плеер, дальше разберется after
+        return following.read()
+
+    def _crossfade(self, data):
+        left = self.current.frames_left()
+        if left is None or left >= self.crossfade_frames:
+            return data
+        with self._lock:
+            following = self._next
+        if following is None or following.is_opus():
+            return data
+        incoming = following.read_nowait()
+        if not incoming:
+            return data
+        return mix_pcm(data, incoming, 1 - left / self.crossfade_frames)
+
+    def is_opus(self):
+        return self.current.is_opus()
+
+    def cleanup(self):
+        with self._lock:
+            self._closed = True
+            following, self._next = self._next, None
+        self.current.cleanup()
+        if following:
+            following.cleanup()
+
+
+# Пометки версий, которые не подходят, если их нет в названии трека из Spotify
+SEARCH_VERSION_MARKERS = (
+    'live', 'cover', 'remix', 'karaoke', 'instrumental', 'nightcore', 'sped up', 'slowed', 'reverb', '8d', 'acoustic'
 )
 
 
-def safe_log_info(message):
-    """Безопасное логирование с обработкой Unicode"""
-    try:
-        # Преобразуем в строку и заменяем проблемные символы
-        safe_message = str(message).encode('utf-8', errors='replace').decode('utf-8')
-        logging.info(safe_message)
-    except Exception as e:
-        # Фолбэк на простой вывод
-        print(f"LOG: {message}")
+def _search_tokens(text):
+    return set(re.findall(r'\w+', (text or '').lower()))
+
+
+def score_search_candidate(entry, spotify_data):
+    """Оценка кандидата из поиска YouTube для трека Spotify: 0..1, больше - лучше"""
+    title_tokens = _search_tokens(entry.get('title'))
+    channel_tokens = _search_tokens(entry.get('channel') or entry.get('uploader'))
+
+    name_tokens = _search_tokens(spotify_data['name'])
+    name_score = len(name_tokens & title_tokens) / len(name_tokens) if name_tokens else 0
+    artist_tokens = _search_tokens(' '.join(spotify_data.get('artists') or []))
+    artist_score = len(artist_tokens & (title_tokens | channel_tokens)) / len(artist_tokens) if artist_tokens else 0
+
+    duration = entry.get('duration')
+    if duration and spotify_data.get('duration_ms'):
+        # Одинаковая запись обычно отличается на пару секунд, клип с интро - на десятки
+        duration_score = max(0.0, 1 - abs(duration - spotify_data['duration_ms'] / 1000) / 30)
+    else:
+        duration_score = 0.5
+
+    penalty = 0.3 if any(
+        set(marker.split()) <= title_tokens and not set(marker.split()) <= name_tokens
+        for marker in SEARCH_VERSION_MARKERS
+    ) else 0
+    return 0.4 * name_score + 0.25 * artist_score + 0.35 * duration_score - penalty
+
+
+class Track:
+    """Трек очереди: только нужные поля; строки интернируются, ведь одни и те же
+    плейлисты загружены сразу в нескольких сессиях"""
+
+    __slots__ = ('url', 'title', 'duration', 'spotify_id')
+
+    def __init__(self, url, title, duration=0, spotify_id=None):
+        self.url = sys.intern(url)
+        self.title = sys.intern(title)
+        self.duration = duration or 0
+        self.spotify_id = spotify_id
+
+    @classmethod
+    def from_dict(cls, data):
+        """Запись кеша: текущий формат или старый, с url/original_url/spotify_data"""
+        spotify_data = data.get('spotify_data') or {}
+        return cls(
+            data.get('original_url') or data['url'],
+            data.get('title') or 'Без названия',
+            data.get('duration') or spotify_data.get('duration_ms', 0) / 1000,
+            data.get('spotify_id') or spotify_data.get('id')
+        )
+
+    def to_dict(self):
+        data = {'url': self.url, 'title': self.title, 'duration': self.duration}
+        if self.spotify_id:
+            data['spotify_id'] = self.spotify_id
+        return data
+
+
+class TrackQueue:
+    """Треки в исходном порядке и отдельная перестановка порядка воспроизведения.
+
+    Индексация, длина и перебор идут в порядке воспроизведения, поэтому current_position
+    и номера в /goto работают одинаково с перемешиванием и без него. Перемешивание
+    меняет только перестановку: исходный порядок (и то, что пишется в кеш) не трогается.
+    """
+
+    def __init__(self, tracks=()):
+        self.tracks = list(tracks)
+        # None - исходный порядок, иначе array индексов self.tracks
+        self.order = None
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __getitem__(self, position):
+        return self.tracks[self.order[position] if self.order is not None else position]
+
+    def __iter__(self):
+        if self.order is None:
+            return iter(self.tracks)
+        return (self.tracks[index] for index in self.order)
+
+    @property
+    def shuffled(self):
+        return self.order is not None
+
+    def append(self, track):
+        self.tracks.append(track)
+        if self.order is not None:
+            self.order.append(len(self.tracks) - 1)
+
+    def insert(self, position, track):
+        if self.order is None:
+            self.tracks.insert(position, track)
+        else:
+            self.tracks.append(track)
+            self.order.insert(position, len(self.tracks) - 1)
+
+    def original_index(self, position):
+        return self.order[position] if self.order is not None else position
+
+    def position_of(self, index):
+        """Позиция воспроизведения трека с исходным номером index"""
+        return self.order.index(index) if self.order is not None else index
+
+    def shuffle(self, first=None):
+        """Перемешивает порядок воспроизведения; трек с исходным номером first ставится первым"""
+        order = array('I', range(len(self.tracks)))
+        random.shuffle(order)
+        if first is not None:
+            at = order.index(first)
+            order[0], order[at] = order[at], order[0]
+        self.order = order
+
+    def unshuffle(self):
+        self.order = None
+
+    def to_dicts(self):
+        return [track.to_dict() for track in self.tracks]
+
+
+def track_from_entry(entry):
+    """Трек плейлиста из плоской записи yt-dlp или None, если у записи нет страницы"""
+    if not entry or entry.get('is_unavailable'):
+        return None
+    track_page = entry.get('webpage_url') or entry.get('url')
+    if not track_page or not track_page.startswith("http"):
+        return None
+    return Track(track_page, entry.get('title') or 'Без названия', entry.get('duration'))
+
+
+# Параметры, которые не меняют содержимое страницы (трекинг, источник перехода)
+IGNORED_QUERY_PARAMS = {'si', 'feature', 'pp', 'ab_channel', 'index', 'pbjreload', 'fbclid', 'gclid'}
+
+
+def normalize_media_query(query):
+    """Ключ для объединения одинаковых запросов: разные записи одной ссылки дают один ключ"""
+    query = ' '.join(query.split())
+    parsed = urlparse(query)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        return query
+    host = parsed.hostname.lower()
+    for prefix in ('www.', 'm.', 'music.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    params = parse_qs(parsed.query)
+    path = parsed.path.rstrip('/')
+    if host == 'youtu.be' and path:
+        host, params['v'] = 'youtube.com', [path.lstrip('/')]
+        path = '/watch'
+    kept = sorted(
+        (key, value) for key, values in params.items()
+        if key not in IGNORED_QUERY_PARAMS and not key.startswith('utm_')
+        for value in values
+    )
+    return f"{host}{path}?{'&'.join(f'{key}={value}' for key, value in kept)}"
+
+
+# yt-dlp и spotipy тяжелые: импортируются при первом использовании, а не при старте
+YoutubeDL = None
+
+
+def load_youtube_dl():
+    global YoutubeDL
+    if YoutubeDL is None:
+        from yt_dlp import YoutubeDL as youtube_dl_class
+        YoutubeDL = youtube_dl_class
+    return YoutubeDL
+
+
+def write_json_atomic(path, data):
+    """Пишет JSON во временный файл и атомарно подменяет целевой"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = path.with_suffix('.tmp')
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_file, path)
+
+
+# Опции ffmpeg, относящиеся ко входу (-i): их нужно передавать в before_options
+FFMPEG_INPUT_OPTIONS = {
+    '-reconnect', '-reconnect_streamed', '-reconnect_delay_max', '-reconnect_at_eof',
+    '-reconnect_on_network_error', '-reconnect_on_http_error', '-rw_timeout', '-timeout',
+    '-user_agent', '-headers', '-ss', '-analyzeduration', '-probesize', '-thread_queue_size'
+}
+FFMPEG_INPUT_FLAGS = {'-re', '-nostdin'}
+FFMPEG_FILTER_OPTIONS = {'-af', '-filter:a', '-filter_complex'}
+DEFAULT_FFMPEG_BEFORE_OPTIONS = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+
+
+def split_ffmpeg_options(options):
+    """Делит строку FFmpegSettings.Options на входные и выходные опции и отдельно фильтры"""
+    tokens = shlex.split(options or '')
+    before, output, filters = [], [], []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        has_value = i + 1 < len(tokens) and token not in FFMPEG_INPUT_FLAGS and (
+            not tokens[i + 1].startswith('-') or tokens[i + 1][1:].replace('.', '', 1).isdigit()
+        )
+        pair = tokens[i:i + 2] if has_value else [token]
+        if token in FFMPEG_INPUT_OPTIONS or token in FFMPEG_INPUT_FLAGS:
+            before.extend(pair)
+        elif token in FFMPEG_FILTER_OPTIONS:
+            filters.extend(pair)
+        else:
+            output.extend(pair)
+        i += len(pair)
+    return shlex.join(before), shlex.join(output), shlex.join(filters)
+
+
+# Параметры loudnorm: короткие и длинные имена, значения по умолчанию как у ffmpeg
+LOUDNORM_PARAMS = {'i': 'i', 'integrated': 'i', 'tp': 'tp', 'true_peak': 'tp', 'lra': 'lra'}
+LOUDNORM_DEFAULTS = {'i': -24.0, 'tp': -2.0, 'lra': 7.0}
+# JSON, который loudnorm с print_format=json печатает в stderr в конце прохода
+LOUDNORM_STATS = re.compile(r'\{[^{}]*"input_i"[^{}]*\}')
+
+
+def replace_loudnorm(filters, replacement=None):
+    """Заменяет loudnorm в фильтрах на replacement (или убирает его).
+
+    Возвращает новую строку фильтров и цели loudnorm {'i', 'tp', 'lra'} или None, если его не было.
+    """
+    tokens = shlex.split(filters or '')
+    target = None
+    result = []
+    i = 0
+    while i < len(tokens):
+        if tokens[i] not in FFMPEG_FILTER_OPTIONS or i + 1 >= len(tokens):
+            result.append(tokens[i])
+            i += 1
+            continue
+        chain = []
+        for part in tokens[i + 1].split(','):
+            name, _, args = part.partition('=')
+            if name.strip() != 'loudnorm':
+                chain.append(part)
+                continue
+            target = dict(LOUDNORM_DEFAULTS)
+            for param in filter(None, args.split(':')):
+                key, _, value = param.partition('=')
+                if key.lower() in LOUDNORM_PARAMS:
+                    target[LOUDNORM_PARAMS[key.lower()]] = float(value)
+            if replacement:
+                chain.append(replacement)
+        if chain:
+            result.extend([tokens[i], ','.join(chain)])
+        i += 2
+    return shlex.join(result), target
+
+
+def loudness_gain(integrated, true_peak, target):
+    """Постоянное усиление в дБ до целевой громкости, не поднимающее пик выше цели"""
+    return round(min(target['i'] - integrated, target['tp'] - true_peak), 2)
 
 
 class BotConfig:
@@ -81,6 +730,42 @@ class BotConfig:
         self.spotify_client_secret = bot_settings["SpotifyClientSecret"]
         self.cache_enabled = bot_settings["CacheEnabled"]
         self.cache_dir = bot_settings["CacheDir"]
+        self.cache_ttl = bot_settings.get("CacheTTL", 7 * 24 * 3600)
+        self.cache_max_bytes = bot_settings.get("CacheMaxBytes", 200 * 1024 * 1024)
+        self.lookahead_tracks = bot_settings.get("LookaheadTracks", 2)
+        self.gapless_playback = bot_settings.get("GaplessPlayback", True)
+        self.prebuffer_seconds = bot_settings.get("PrebufferSeconds", 3)
+        self.prepare_ahead_seconds = bot_settings.get("PrepareAheadSeconds", 15)
+        # Остаток трека известен, только когда ffmpeg дочитал его в буфер, поэтому наложение
+        # не может быть длиннее буфера
+        self.crossfade_seconds = min(bot_settings.get("CrossfadeSeconds", 0), self.prebuffer_seconds)
+        self.auto_resume = bot_settings.get("AutoResume", True)
+        self.loudness_analysis = bot_settings.get("LoudnessAnalysis", True)
+        self.warm_up = bot_settings.get("WarmUp", True)
+        self.warm_up_tracks = bot_settings.get("WarmUpTracks", 3)
+        self.resume_attempts = bot_settings.get("ResumeAttempts", 3)
+        self.stream_cache_size = bot_settings.get("StreamCacheSize", 500)
+        self.stream_cache_persist = bot_settings.get("StreamCachePersist", False)
+        self.play_extractor_workers = bot_settings.get("PlayExtractorWorkers", 2)
+        self.bulk_extractor_workers = bot_settings.get("BulkExtractorWorkers", 4)
+        self.extractor_mode = bot_settings.get("ExtractorMode", "thread")
+        self.extractor_process_max_tasks = bot_settings.get("ExtractorProcessMaxTasks", 200)
+        self.spotify_concurrency = bot_settings.get("SpotifyConcurrency", 8)
+        self.audio_cache_enabled = bot_settings.get("AudioCacheEnabled", False)
+        self.audio_cache_max_bytes = bot_settings.get("AudioCacheMaxBytes", 2 * 1024 * 1024 * 1024)
+        self.audio_cache_hot_plays = bot_settings.get("AudioCacheHotPlays", 2)
+        self.audio_cache_policy = bot_settings.get("AudioCachePolicy", "lru")
+        self.spotify_page_concurrency = bot_settings.get("SpotifyPageConcurrency", 4)
+        self.playlist_refresh_interval = bot_settings.get("PlaylistRefreshInterval", 6 * 3600)
+        self.playlist_refresh_quiet_hours = bot_settings.get("PlaylistRefreshQuietHours")
+        self.playlist_refresh_delay = bot_settings.get("PlaylistRefreshDelay", 1.0)
+        self.spotify_search_results = bot_settings.get("SpotifySearchResults", 5)
+        self.metrics_host = bot_settings.get("MetricsHost", "127.0.0.1")
+        self.metrics_port = bot_settings.get("MetricsPort", 0)
+        self.sharded = bot_settings.get("Sharded", False)
+        self.shard_count = bot_settings.get("ShardCount")
+        self.log_max_bytes = bot_settings.get("LogMaxBytes", 10 * 1024 * 1024)
+        self.log_backup_count = bot_settings.get("LogBackupCount", 5)
 
         # YoutubeDLSettings
         yt_settings = config_data["YoutubeDLSettings"]
@@ -98,48 +783,928 @@ class BotConfig:
         self.ffmpeg_options = ffmpeg_settings["Options"]
 
 
-class MusicCog(commands.Cog):
-    def __init__(self, bot, config):
-        self.bot = bot
-        self.config = config
+class StreamUrlCache:
+    """LRU кеш прямых аудио URL, учитывающий срок жизни ссылки"""
+
+    # Ссылки без явного срока жизни считаем живыми час
+    DEFAULT_TTL = 3600
+    # Запас до истечения, чтобы ссылка не протухла посреди трека
+    SAFETY_MARGIN = 600
+    SAVE_INTERVAL = 60
+
+    def __init__(self, max_entries, persist_path=None):
+        self.max_entries = max_entries
+        self.persist_path = Path(persist_path) if persist_path else None
+        self._entries = OrderedDict()  # original_url -> {'stream': ..., 'expires_at': ...}
+        self._last_save = 0
+        self._write_lock = threading.Lock()
+        self._flush_task = None
+        self.hits = 0
+        self.misses = 0
+        if self.persist_path:
+            self._load()
+
+    @classmethod
+    def expiry_from_url(cls, audio_url):
+        """Достает время истечения из медиа URL (например googlevideo ?expire=)"""
+        parsed = urlparse(audio_url)
+        query = parse_qs(parsed.query)
+        for key in ('expire', 'expires', 'Expires'):
+            if key in query and query[key][0].isdigit():
+                return int(query[key][0])
+        match = re.search(r'/expire/(\d+)', parsed.path)
+        if match:
+            return int(match.group(1))
+        return time.time() + cls.DEFAULT_TTL
+
+    def get(self, page_url):
+        entry = self._entries.get(page_url)
+        if entry and entry['expires_at'] - self.SAFETY_MARGIN > time.time():
+            self._entries.move_to_end(page_url)
+            self.hits += 1
+            return dict(entry['stream'], cached=True)
+        if entry:
+            del self._entries[page_url]
+        self.misses += 1
+        return None
+
+    def put(self, page_url, stream):
+        self._entries[page_url] = {
+            'stream': dict(stream, cached=False),
+            'expires_at': self.expiry_from_url(stream['url'])
+        }
+        self._entries.move_to_end(page_url)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        if self.persist_path and time.monotonic() - self._last_save > self.SAVE_INTERVAL:
+            self._last_save = time.monotonic()
+            if not (self._flush_task and not self._flush_task.done()):
+                self._flush_task = asyncio.create_task(self.flush())
+
+    def invalidate(self, page_url):
+        self._entries.pop(page_url, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0
+        }
+
+    def _load(self):
+        try:
+            with open(self.persist_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for page_url, entry in entries:
+            if entry['expires_at'] - self.SAFETY_MARGIN > now:
+                self._entries[page_url] = entry
+
+    async def flush(self):
+        """Сохраняет кеш в фоновом потоке, снимок берется в event loop"""
+        if self.persist_path:
+            await asyncio.to_thread(self._write, list(self._entries.items()))
+
+    def save(self):
+        """Синхронное сохранение при выгрузке"""
+        if self.persist_path:
+            self._write(list(self._entries.items()))
+
+    def _write(self, entries):
+        with self._write_lock:
+            try:
+                write_json_atomic(self.persist_path, entries)
+            except OSError as e:
+                safe_log_info(f"Не удалось сохранить кеш ссылок: {e}")
+
+
+class PlaylistCacheStore:
+    """Кеш плейлистов в одном SQLite файле: атомарная запись, TTL, LRU вытеснение по размеру"""
+
+    def __init__(self, path, ttl, max_bytes):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS playlists (
+                cache_key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                last_updated REAL NOT NULL,
+                last_access REAL NOT NULL,
+                track_count INTEGER NOT NULL,
+                size_bytes INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS playlist_tracks (
+                cache_key TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (cache_key, position)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS track_loudness (
+                url TEXT PRIMARY KEY,
+                integrated REAL NOT NULL,
+                true_peak REAL NOT NULL,
+                analyzed_at REAL NOT NULL
+            ) WITHOUT ROWID;
+        """)
+
+    def get_meta(self, cache_key, allow_stale=False):
+        """Метаданные плейлиста или None, если его нет или истек TTL"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT url, last_updated, track_count FROM playlists WHERE cache_key = ?", (cache_key,)
+            ).fetchone()
+        if not row:
+            return None
+        url, last_updated, track_count = row
+        if not allow_stale and self.ttl and time.time() - last_updated > self.ttl:
+            return None
+        return {'url': url, 'last_updated': last_updated, 'track_count': track_count}
+
+    def load_tracks(self, cache_key, offset=0, limit=None, version=None):
+        """Читает только запрошенный диапазон треков, не разбирая весь плейлист.
+
+        С version возвращает None, если плейлист успели перезаписать другой версией.
+        """
+        with self._lock:
+            if version is not None:
+                row = self._db.execute(
+                    "SELECT last_updated FROM playlists WHERE cache_key = ?", (cache_key,)
+                ).fetchone()
+                if not row or row[0] != version:
+                    return None
+            rows = self._db.execute(
+                "SELECT data FROM playlist_tracks WHERE cache_key = ? AND position >= ? "
+                "ORDER BY position LIMIT ?",
+                (cache_key, offset, -1 if limit is None else limit)
+            ).fetchall()
+            self._db.execute(
+                "UPDATE playlists SET last_access = ? WHERE cache_key = ?", (time.time(), cache_key)
+            )
+        return [json.loads(data) for (data,) in rows]
+
+    def load(self, cache_key, allow_stale=False):
+        meta = self.get_meta(cache_key, allow_stale)
+        if not meta:
+            return None
+        return {
+            'url': meta['url'],
+            'last_updated': datetime.fromtimestamp(meta['last_updated'], timezone.utc).isoformat(),
+            'tracks': self.load_tracks(cache_key)
+        }
+
+    def save(self, cache_key, url, tracks):
+        rows = [(cache_key, position, json.dumps(track, ensure_ascii=False))
+                for position, track in enumerate(tracks)]
+        size = sum(len(data) for _, _, data in rows)
+        now = time.time()
+        with self._lock:
+            # Одна транзакция: читатели видят либо старую, либо новую версию целиком
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("DELETE FROM playlist_tracks WHERE cache_key = ?", (cache_key,))
+                self._db.executemany(
+                    "INSERT INTO playlist_tracks (cache_key, position, data) VALUES (?, ?, ?)", rows
+                )
+                self._db.execute(
+                    "INSERT OR REPLACE INTO playlists "
+                    "(cache_key, url, last_updated, last_access, track_count, size_bytes) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (cache_key, url, now, now, len(rows), size)
+                )
+                self._evict(keep=cache_key)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def load_loudness(self):
+        """Все замеры громкости: url -> (integrated, true_peak)"""
+        with self._lock:
+            rows = self._db.execute("SELECT url, integrated, true_peak FROM track_loudness").fetchall()
+        return {url: (integrated, true_peak) for url, integrated, true_peak in rows}
+
+    def save_loudness(self, url, integrated, true_peak):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO track_loudness (url, integrated, true_peak, analyzed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (url, integrated, true_peak, time.time())
+            )
+
+    def _evict(self, keep=None):
+        total = self._db.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM playlists").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for cache_key, size in self._db.execute(
+                "SELECT cache_key, size_bytes FROM playlists ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            if cache_key == keep:
+                continue
+            self._db.execute("DELETE FROM playlist_tracks WHERE cache_key = ?", (cache_key,))
+            self._db.execute("DELETE FROM playlists WHERE cache_key = ?", (cache_key,))
+            total -= size
+            safe_log_info(f"Кеш плейлистов: вытеснен {cache_key}")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class SpotifyTrackIndex:
+    """Постоянный индекс: Spotify track id -> выбранный для него YouTube трек"""
+
+    SAVE_EVERY = 50
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else None
+        self._entries = {}
+        self._unsaved = 0
+        self._write_lock = threading.Lock()
+        self._flush_task = None
+        if self.path and self.path.exists():
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError) as e:
+                safe_log_info(f"Не удалось прочитать индекс Spotify: {e}")
+
+    def get(self, track_id):
+        return self._entries.get(track_id) if track_id else None
+
+    def put(self, track_id, title, original_url, duration=0):
+        if not track_id:
+            return
+        self._entries[track_id] = {'title': title, 'original_url': original_url, 'duration': duration or 0}
+        self._unsaved += 1
+        if self._unsaved >= self.SAVE_EVERY and not (self._flush_task and not self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        """Сохраняет индекс в фоновом потоке: запись большого JSON не должна останавливать event loop"""
+        if not self.path or not self._unsaved:
+            return
+        # Снимок берется в event loop, пока словарь никто не меняет
+        entries, unsaved, self._unsaved = dict(self._entries), self._unsaved, 0
+        if not await asyncio.to_thread(self._write, entries):
+            self._unsaved += unsaved
+
+    def save(self):
+        """Синхронное сохранение при выгрузке"""
+        if self.path and self._unsaved and self._write(self._entries):
+            self._unsaved = 0
+
+    def _write(self, entries):
+        with self._write_lock:
+            try:
+                write_json_atomic(self.path, entries)
+                return True
+            except OSError as e:
+                safe_log_info(f"Не удалось сохранить индекс Spotify: {e}")
+                return False
+
+
+class AudioFileCache:
+    """Локальные Ogg/Opus копии популярных треков с бюджетом по байтам и вытеснением LRU/LFU"""
+
+    def __init__(self, directory, max_bytes, hot_plays, policy='lru'):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.directory / "index.json"
+        self.max_bytes = max_bytes
+        self.hot_plays = hot_plays
+        self.policy = policy
+        # original_url -> {'path', 'size', 'plays', 'last_access'}
+        self._entries = {}
+        # Счетчики прослушиваний треков, которых еще нет на диске
+        self._plays = {}
+        self._queued = set()
+        self.hits = 0
+        self.misses = 0
+        self._write_lock = threading.Lock()
+        if self.index_path.exists():
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    entries = json.load(f)
+                self._entries = {url: e for url, e in entries.items() if Path(e['path']).exists()}
+            except (OSError, ValueError) as e:
+                safe_log_info(f"Не удалось прочитать индекс аудио кеша: {e}")
+
+    def get(self, page_url):
+        entry = self._entries.get(page_url)
+        if entry and Path(entry['path']).exists():
+            self.hits += 1
+            return entry['path']
+        if entry:
+            del self._entries[page_url]
+        self.misses += 1
+        return None
+
+    def record_play(self, page_url):
+        """Учитывает прослушивание; возвращает True, если трек пора положить на диск"""
+        entry = self._entries.get(page_url)
+        if entry:
+            entry['plays'] += 1
+            entry['last_access'] = time.time()
+            return False
+        plays = self._plays[page_url] = self._plays.get(page_url, 0) + 1
+        if plays >= self.hot_plays and page_url not in self._queued:
+            self._queued.add(page_url)
+            return True
+        return False
+
+    def add(self, page_url, path):
+        path = Path(path)
+        self._queued.discard(page_url)
+        if not path.exists():
+            return
+        self._entries[page_url] = {
+            'path': str(path),
+            'size': path.stat().st_size,
+            'plays': self._plays.pop(page_url, 0),
+            'last_access': time.time()
+        }
+        self._evict()
+
+    def discard(self, page_url):
+        self._queued.discard(page_url)
+
+    def _evict(self):
+        total = sum(e['size'] for e in self._entries.values())
+        if total <= self.max_bytes:
+            return
+        if self.policy == 'lfu':
+            order = sorted(self._entries, key=lambda u: (self._entries[u]['plays'], self._entries[u]['last_access']))
+        else:
+            order = sorted(self._entries, key=lambda u: self._entries[u]['last_access'])
+        for url in order:
+            if total <= self.max_bytes:
+                break
+            entry = self._entries.pop(url)
+            total -= entry['size']
+            try:
+                Path(entry['path']).unlink()
+            except OSError:
+                pass
+
+    def stats(self):
+        return {
+            'files': len(self._entries),
+            'bytes': sum(e['size'] for e in self._entries.values()),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+    async def flush(self):
+        """Сохраняет индекс в фоновом потоке по снимку из event loop"""
+        await asyncio.to_thread(self.save, copy.deepcopy(self._entries))
+
+    def save(self, entries=None):
+        with self._write_lock:
+            try:
+                write_json_atomic(self.index_path, self._entries if entries is None else entries)
+            except OSError as e:
+                safe_log_info(f"Не удалось сохранить индекс аудио кеша: {e}")
+
+
+# Поля результатов yt-dlp, которые использует бот; остальное не передается между процессами
+INFO_FIELDS = ('_type', 'id', 'title', 'url', 'webpage_url', 'original_url', 'acodec', 'vcodec', 'ext', 'duration')
+ENTRY_FIELDS = ('_type', 'id', 'title', 'url', 'webpage_url', 'original_url', 'duration',
+                'channel', 'uploader', 'is_unavailable')
+FORMAT_FIELDS = ('url', 'acodec', 'vcodec', 'ext')
+
+
+def trim_info(info):
+    """Оставляет из ответа yt-dlp только используемые поля"""
+    if not info:
+        return info
+    trimmed = {key: info[key] for key in INFO_FIELDS if key in info}
+    if info.get('entries') is not None:
+        trimmed['entries'] = [
+            {key: entry[key] for key in ENTRY_FIELDS if key in entry} if entry else None
+            for entry in info['entries']
+        ]
+    if info.get('formats'):
+        trimmed['formats'] = [{key: f[key] for key in FORMAT_FIELDS if key in f} for f in info['formats']]
+    if info.get('requested_downloads'):
+        trimmed['requested_downloads'] = [
+            {'filepath': download.get('filepath')} for download in info['requested_downloads']
+        ]
+    return trimmed
+
+
+# Состояние рабочего процесса извлечения: опции и прогретые экземпляры по профилям
+_process_ydl_opts = {}
+_process_instances = {}
+
+
+def _process_worker_init(base_opts, profiles):
+    _process_ydl_opts.update({name: dict(base_opts, **overrides) for name, overrides in profiles.items()})
+    # Импорт и создание экземпляров сразу, чтобы первое извлечение не платило за прогрев
+    youtube_dl = load_youtube_dl()
+    for name, opts in _process_ydl_opts.items():
+        if name != 'download':
+            _process_instances[name] = youtube_dl(opts)
+
+
+def _process_extract(query, profile, download):
+    ydl = _process_instances.get(profile)
+    if ydl is None:
+        ydl = _process_instances[profile] = load_youtube_dl()(_process_ydl_opts[profile])
+    return trim_info(ydl.extract_info(query, download=download))
+
+
+class ExtractorPool:
+    """Долгоживущие экземпляры YoutubeDL на выделенных потоках с раздельными очередями"""
+
+    # Очередь воспроизведения: то, что нужно прямо сейчас (текущий и следующие треки)
+    PLAY = 'play'
+    # Очередь массовых операций: импорт плейлистов и поиск треков Spotify
+    BULK = 'bulk'
+
+    def __init__(self, base_opts, play_workers, bulk_workers, use_processes=False, process_max_tasks=None):
+        self.base_opts = base_opts
+        self.profiles = {'default': {}}
+        self._workers = {self.PLAY: play_workers, self.BULK: bulk_workers}
+        self._executors = {
+            self.PLAY: ThreadPoolExecutor(max_workers=play_workers, thread_name_prefix='ydl-play'),
+            self.BULK: ThreadPoolExecutor(max_workers=bulk_workers, thread_name_prefix='ydl-bulk'),
+        }
+        # В режиме процессов extract уходит в отдельные процессы и не делит GIL с голосовым потоком;
+        # iter_entries остается на потоках, так как отдает записи по мере получения
+        self.use_processes = use_processes
+        self.process_max_tasks = process_max_tasks
+        self._process_pools = {}
+        self._process_tasks = {self.PLAY: 0, self.BULK: 0}
+        self._pending = {self.PLAY: 0, self.BULK: 0}
+        self._running = {self.PLAY: 0, self.BULK: 0}
+        # _running меняют потоки пула, а читает event loop
+        self._running_lock = threading.Lock()
+        self._local = threading.local()
+        self._instances = []
+        self._instances_lock = threading.Lock()
+        # Извлечения в процессе: (профиль, download, нормализованный запрос) -> asyncio.Task
+        self._inflight = {}
+
+    def add_profile(self, name, **overrides):
+        """Регистрирует набор опций поверх базовых, не трогая общий словарь"""
+        self.profiles[name] = overrides
+
+    def _get_ydl(self, profile):
+        # Каждый поток держит по одному экземпляру на профиль: YoutubeDL не потокобезопасен
+        instances = getattr(self._local, 'instances', None)
+        if instances is None:
+            instances = self._local.instances = {}
+        ydl = instances.get(profile)
+        if ydl is None:
+            ydl = load_youtube_dl()(dict(self.base_opts, **self.profiles[profile]))
+            instances[profile] = ydl
+            with self._instances_lock:
+                self._instances.append(ydl)
+        return ydl
+
+    def _get_process_pool(self, lane):
+        # Пул создается при первом извлечении: к этому моменту все профили уже добавлены.
+        # Пересоздание пула раз в process_max_tasks задач ограничивает рост памяти процессов;
+        # max_tasks_per_child не используем - в Python 3.11 он может зависнуть при перезапуске
+        pool = self._process_pools.get(lane)
+        if pool is None or (self.process_max_tasks and self._process_tasks[lane] >= self.process_max_tasks):
+            if pool:
+                # Старый пул доделает уже отправленные задачи и завершится
+                pool.shutdown(wait=False)
+            pool = self._process_pools[lane] = ProcessPoolExecutor(
+                max_workers=self._workers[lane],
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_process_worker_init,
+                initargs=(self.base_opts, self.profiles)
+            )
+            self._process_tasks[lane] = 0
+        self._process_tasks[lane] += 1
+        return pool
+
+    @contextmanager
+    def _occupy(self, lane):
+        """Учитывает занятый поток очереди на время извлечения"""
+        with self._running_lock:
+            self._running[lane] += 1
+        try:
+            yield
+        finally:
+            with self._running_lock:
+                self._running[lane] -= 1
+
+    def _extract(self, query, profile, lane, download=False):
+        with self._occupy(lane):
+            return self._get_ydl(profile).extract_info(query, download=download)
+
+    async def extract(self, query, profile='default', lane=BULK, download=False, caller=None):
+        """Одинаковые запросы в процессе объединяются: все ждут одно извлечение.
+
+        Результат общий для всех ожидающих, его нельзя изменять на месте.
+        Отмена одного ожидающего не отменяет общее извлечение.
+        """
+        caller = caller or profile
+        key = (profile, download, normalize_media_query(query))
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._extract_once(query, profile, lane, download, caller))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish_inflight(key, t))
+        else:
+            metrics.inc('ydl_extract_coalesced_total', caller=caller)
+        return await asyncio.shield(task)
+
+    def _finish_inflight(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Забираем исключение, даже если все ожидающие ушли
+        if not task.cancelled():
+            task.exception()
+
+    async def _extract_once(self, query, profile, lane, download, caller):
+        self._pending[lane] += 1
+        result = 'error'
+        started = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            if self.use_processes:
+                info = await loop.run_in_executor(
+                    self._get_process_pool(lane), _process_extract, query, profile, download
+                )
+            else:
+                info = await loop.run_in_executor(
+                    self._executors[lane], self._extract, query, profile, lane, download
+                )
+            result = 'ok' if info else 'empty'
+            return info
+        finally:
+            self._pending[lane] -= 1
+            metrics.observe('ydl_extract_seconds', time.perf_counter() - started, caller=caller, lane=lane)
+            metrics.inc('ydl_extract_total', caller=caller, result=result)
+
+    async def iter_entries(self, query, profile='default', lane=BULK):
+        """Отдает записи плейлиста по мере того, как yt-dlp листает его страницы"""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        stop = threading.Event()
+        finished = object()
+
+        def _produce():
+            try:
+                with self._occupy(lane):
+                    ydl = self._get_ydl(profile)
+                    info = ydl.extract_info(query, download=False, process=False)
+                    # Ссылки-перенаправления (например на вкладку канала) разворачиваем сами
+                    for _ in range(3):
+                        if not info or info.get('_type') != 'url':
+                            break
+                        info = ydl.extract_info(info['url'], download=False, process=False)
+                    if not info:
+                        return
+                    if info.get('_type') in ('playlist', 'multi_video'):
+                        for entry in info.get('entries') or []:
+                            if stop.is_set():
+                                return
+                            loop.call_soon_threadsafe(queue.put_nowait, entry)
+                    else:
+                        loop.call_soon_threadsafe(queue.put_nowait, info)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, finished)
+
+        self._pending[lane] += 1
+        loop.run_in_executor(self._executors[lane], _produce)
+        started = time.perf_counter()
+        count = 0
+        try:
+            while True:
+                item = await queue.get()
+                if item is finished:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                count += 1
+                yield item
+        finally:
+            stop.set()
+            self._pending[lane] -= 1
+            metrics.observe('playlist_enumerate_seconds', time.perf_counter() - started, lane=lane)
+            metrics.inc('playlist_entries_total', count, lane=lane)
+
+    def queue_depth(self, lane):
+        """Сколько извлечений ждут свободного потока в очереди"""
+        if self.use_processes:
+            # Занятость процессов отсюда не видна: считаем, что все они работают
+            return max(0, self._pending[lane] - self._workers[lane])
+        return max(0, self._pending[lane] - self._running[lane])
+
+    def in_flight(self, lane):
+        """Сколько извлечений в очереди или в работе"""
+        return self._pending[lane]
+
+    def shutdown(self):
+        for executor in list(self._executors.values()) + list(self._process_pools.values()):
+            executor.shutdown(wait=False, cancel_futures=True)
+        with self._instances_lock:
+            for ydl in self._instances:
+                try:
+                    ydl.close()
+                except Exception:
+                    pass
+            self._instances.clear()
+
+
+class PlaylistRefresher:
+    """Фоновое обновление плейлистов: сессии играют сохраненную версию, пока готовится новая"""
+
+    CHECK_INTERVAL = 60
+    # Пауза перед повтором, если обновление плейлиста не удалось
+    RETRY_AFTER = 15 * 60
+
+    def __init__(self, cog):
+        self.cog = cog
+        self.config = cog.config
+        self.interval = self.config.playlist_refresh_interval
+        self.quiet_hours = self.config.playlist_refresh_quiet_hours
+        self._requests = asyncio.Queue()
+        self._queued = set()
+        self._last_attempt = {}
+        self._task = None
+
+    def start(self):
+        if self.interval and self.cog.playlist_store:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def is_stale(self, last_updated):
+        """last_updated - время сохранения версии плейлиста (unix time)"""
+        return bool(self.interval) and time.time() - last_updated >= self.interval
+
+    def request(self, url):
+        """Ставит плейлист на внеочередное обновление (например, если выдали устаревший кеш)"""
+        if self._task and url not in self._queued:
+            self._queued.add(url)
+            self._requests.put_nowait(url)
+
+    def _in_quiet_hours(self):
+        if not self.quiet_hours:
+            return True
+        start, end = self.quiet_hours
+        hour = datetime.now().hour
+        return start <= hour < end if start <= end else hour >= start or hour < end
+
+    async def _is_due(self, url):
+        if time.time() - self._last_attempt.get(url, 0) < self.RETRY_AFTER:
+            return False
+        meta = await asyncio.to_thread(
+            self.cog.playlist_store.get_meta, self.cog._get_playlist_cache_key(url), True
+        )
+        return not meta or time.time() - meta['last_updated'] >= self.interval
+
+    async def _run(self):
+        while True:
+            try:
+                url = await asyncio.wait_for(self._requests.get(), timeout=self.CHECK_INTERVAL)
+                self._queued.discard(url)
+                urls = [url]
+            except asyncio.TimeoutError:
+                urls = []
+                if self._in_quiet_hours():
+                    for url in self.config.playlist_urls.values():
+                        if url and url.startswith("http") and await self._is_due(url):
+                            urls.append(url)
+            for url in urls:
+                try:
+                    await self.refresh(url)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    safe_log_info(f"Не удалось обновить плейлист: {e}", exc_info=True, url=url)
+
+    async def _wait_for_idle_playback(self):
+        """Обновление уступает место извлечениям для воспроизведения"""
+        while self.cog.extractors.in_flight(ExtractorPool.PLAY):
+            await asyncio.sleep(0.5)
+
+    async def refresh(self, url):
+        self._last_attempt[url] = time.time()
+        started = time.perf_counter()
+        await self._wait_for_idle_playback()
+        if "spotify.com" in url:
+            tracks = await self._collect_spotify(url)
+        else:
+            tracks = await self._collect_flat(url)
+        if not tracks:
+            safe_log_info("Обновление плейлиста вернуло пустой список, оставляем старую версию", url=url)
+            return
+
+        await asyncio.to_thread(self.cog._save_to_cache, self.cog._get_playlist_cache_key(url), {
+            'url': url,
+            'last_updated': datetime.now(timezone.utc).isoformat(),
+            'tracks': [track.to_dict() for track in tracks]
+        })
+        if url in self.cog.preloaded:
+            await self.cog.remember_preloaded(url, tracks)
+        swapped = sum(
+            1 for player in list(self.cog.players.values())
+            if player.playlist_url == url and player.replace_playlist(tracks)
+        )
+        metrics.observe('playlist_refresh_seconds', time.perf_counter() - started)
+        safe_log_info(
+            f"Плейлист обновлен: {len(tracks)} треков, сессий: {swapped}",
+            url=url, tracks=len(tracks), sessions=swapped
+        )
+
+    async def _collect_flat(self, url):
+        tracks = []
+        async with aclosing(self.cog.extractors.iter_entries(url, 'flat', ExtractorPool.BULK)) as entries:
+            async for entry in entries:
+                track = track_from_entry(entry)
+                if track:
+                    tracks.append(track)
+        return tracks
+
+    async def _collect_spotify(self, url):
+        if not self.cog.spotify:
+            return []
+        items = await self.cog.fetch_spotify_tracks(url.split('/')[-1].split('?')[0])
+        tracks = []
+        try:
+            for item in items:
+                if not self.cog.track_index.get(item['spotify_data']['id']):
+                    # Новые треки ищем по одному и с паузой
+                    await self._wait_for_idle_playback()
+                    await asyncio.sleep(self.config.playlist_refresh_delay)
+                entry = await self.cog._resolve_spotify_track(item)
+                if entry:
+                    tracks.append(entry)
+        finally:
+            await self.cog.track_index.flush()
+        return tracks
+
+
+class LoudnessAnalyzer:
+    """Фоновый замер громкости треков одним проходом loudnorm.
+
+    Замер сохраняется в кеш плейлистов, и при следующем воспроизведении вместо живого
+    loudnorm применяется постоянное усиление. Треки без замера играют с loudnorm как раньше.
+    """
+
+    TIMEOUT = 300
+    # Очередь не растет бесконечно: незамеренный трек попросится снова при следующем запуске
+    MAX_QUEUED = 100
+    # Через сколько секунд повторять неудачный замер (ошибка ffmpeg, таймаут, тишина)
+    RETRY_AFTER = 24 * 3600
+
+    def __init__(self, cog):
+        self.cog = cog
+        self.config = cog.config
+        self.target = cog.loudnorm_target
+        self._known = {}
+        self._requests = asyncio.Queue()
+        self._queued = set()
+        # url -> time.monotonic(), раньше которого трек заново не замеряется
+        self._failed = {}
+        self._task = None
+
+    @property
+    def enabled(self):
+        return self._task is not None
+
+    async def start(self):
+        if not (self.config.loudness_analysis and self.target and self.cog.playlist_store):
+            return
+        self._known = await asyncio.to_thread(self.cog.playlist_store.load_loudness)
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def gain_for(self, url):
+        """Усиление в дБ для трека или None, если замера еще нет"""
+        measured = self._known.get(url)
+        return loudness_gain(*measured, self.target) if measured else None
+
+    def request(self, url, stream):
+        """Ставит трек на замер по уже извлеченному потоку"""
+        if not self.enabled or url in self._known or url in self._queued or len(self._queued) >= self.MAX_QUEUED:
+            return
+        if self._failed.get(url, 0) > time.monotonic():
+            return
+        self._queued.add(url)
+        self._requests.put_nowait((url, stream))
+
+    async def _run(self):
+        while True:
+            url, stream = await self._requests.get()
+            try:
+                # Замер уступает место извлечениям для воспроизведения
+                while self.cog.extractors.in_flight(ExtractorPool.PLAY):
+                    await asyncio.sleep(0.5)
+                await self.analyze(url, stream)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                safe_log_info(f"Не удалось измерить громкость: {e}", track=url)
+            finally:
+                self._queued.discard(url)
+            if url in self._known:
+                self._failed.pop(url, None)
+            else:
+                # Иначе каждый запуск плохого трека стоил бы еще одного полного прохода ffmpeg
+                self._failed[url] = time.monotonic() + self.RETRY_AFTER
+
+    async def analyze(self, url, stream):
+        started = time.perf_counter()
+        target = self.target
+        args = [self.config.ffmpeg_path, '-hide_banner', '-nostats']
+        if not stream.get('local'):
+            args += shlex.split(self.cog.ffmpeg_before_options or DEFAULT_FFMPEG_BEFORE_OPTIONS)
+        args += [
+            '-i', stream['url'], '-vn',
+            '-af', f"loudnorm=I={target['i']}:TP={target['tp']}:LRA={target['lra']}:print_format=json",
+            '-f', 'null', '-'
+        ]
+        process = await asyncio.create_subprocess_exec(
+            *args, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), timeout=self.TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            process.kill()
+            await process.wait()
+            raise
+        match = LOUDNORM_STATS.search(stderr.decode('utf-8', errors='replace'))
+        if process.returncode or not match:
+            raise RuntimeError(f"ffmpeg завершился с кодом {process.returncode}")
+        stats = json.loads(match.group(0))
+        integrated, true_peak = float(stats['input_i']), float(stats['input_tp'])
+        # У тишины громкость -inf: такой замер не сохраняем, трек останется на живом loudnorm
+        if not (math.isfinite(integrated) and math.isfinite(true_peak)):
+            return
+        await asyncio.to_thread(self.cog.playlist_store.save_loudness, url, integrated, true_peak)
+        self._known[url] = (integrated, true_peak)
+        metrics.observe('loudness_analysis_seconds', time.perf_counter() - started)
+
+
+class GuildPlayer:
+    """Сессия воспроизведения одного сервера: своя очередь, блокировка и голосовое подключение"""
+
+    HISTORY_SIZE = 100
+
+    def __init__(self, cog, guild_id):
+        self.cog = cog
+        self.bot = cog.bot
+        self.config = cog.config
+        self.guild_id = guild_id
         self.voice_client = None
         self.current_song = None
-        self.full_playlist = []
+        self.full_playlist = TrackQueue()
         self.current_position = 0
+        # Ранее сыгранные треки для /back
+        self.history = deque(maxlen=self.HISTORY_SIZE)
+        self._going_back = False
         self.is_playing = False
         self._manual_skip = False
-        self.bot_start_time = datetime.now(timezone.utc)
-        self.retry_count = 0
         self.last_skip_time = 0
         self.is_loading = False
-        self._init_ytdl()
-        self.spotify = spotipy.Spotify(
-            auth_manager=SpotifyClientCredentials(
-                client_id=self.config.spotify_client_id,
-                client_secret=self.config.spotify_client_secret
-            )
-        ) if self.config.spotify_client_id and self.config.spotify_client_secret else None
-        self._ensure_cache_dir()
+        self._load_task = None
         self._play_lock = asyncio.Lock()
-
-    def _ensure_cache_dir(self):
-        if self.config.cache_enabled and not Path(self.config.cache_dir).exists():
-            Path(self.config.cache_dir).mkdir(parents=True, exist_ok=True)
-
-    def _get_playlist_cache_key(self, playlist_url):
-        return hashlib.md5(playlist_url.encode()).hexdigest()
-
-    def _load_from_cache(self, cache_key):
-        cache_file = Path(self.config.cache_dir) / f"{cache_key}.json"
-        if cache_file.exists():
-            with open(cache_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return None
-
-    def _save_to_cache(self, cache_key, data):
-        cache_file = Path(self.config.cache_dir) / f"{cache_key}.json"
-        with open(cache_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # Заранее извлеченные аудио URL следующих треков: original_url -> asyncio.Task
+        self._lookahead = {}
+        # Момент окончания предыдущего трека, для замера паузы между треками
+        self._track_ended_at = None
+        # Источник плейлиста, чтобы фоновое обновление нашло сессии с ним
+        self.playlist_url = None
+        # Текущий непрерывный поток и задача подготовки следующего трека
+        self._gapless = None
+        self._prepare_task = None
+        # С какой секунды начать следующий запуск текущего трека и сколько раз его уже возобновляли
+        self._resume_offset = 0
+        self._resume_count = 0
+        # Отключение по команде (/stop, /leave): переподключаться не нужно
+        self._leaving = False
+        # Переподключение самим ботом (/play, /random, восстановление): его отключение не обрыв
+        self._reconnecting = False
+        self._recover_task = None
 
     def reset_state(self):
         try:
@@ -159,204 +1724,380 @@ class MusicCog(commands.Cog):
 
                 # Асинхронное отключение
                 if self.voice_client.is_connected():
+                    self._leaving = True
+                    if self._recover_task and not self._recover_task.done():
+                        self._recover_task.cancel()
                     asyncio.create_task(self.voice_client.disconnect(force=True))
         except Exception as e:
             safe_log_info(f"Ошибка в reset_state: {e}")
 
-    def _init_ytdl(self):
-        self.ydl_opts = {
-            'format': 'bestaudio/best',
-            'quiet': True,
-            'no_warnings': False,
-            'default_search': 'auto',
-            'ignoreerrors': True,
-            'extract_flat': False,
-            'live_from_start': True,
-            'cachedir': False,
-            'force_generic_extractor': True,
-            'socket_timeout': 30,
-            'noplaylist': True,
-            'source_address': '0.0.0.0',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': self.config.ydl_audio_format,
-                'preferredquality': self.config.ydl_quality,
-            }],
-            'http_headers': {'User-Agent': self.config.ydl_user_agent},
-            'mark_watched': self.config.ydl_mark_watched,
-            'throttledratelimit': self.config.ydl_throttled_rate,
-        }
-        if os.path.exists(self.config.ydl_cookie_file):
-            self.ydl_opts['cookiefile'] = self.config.ydl_cookie_file
+    def clear(self):
+        """Сбрасывает очередь и фоновые задачи сессии"""
+        if self._load_task and not self._load_task.done():
+            self._load_task.cancel()
+        self._clear_lookahead()
+        if self._prepare_task and not self._prepare_task.done():
+            self._prepare_task.cancel()
+        if self._recover_task and not self._recover_task.done():
+            self._recover_task.cancel()
+        self._gapless = None
+        self._resume_offset = 0
+        self.current_song = None
+        self.full_playlist = TrackQueue()
+        self.current_position = 0
+        self.history.clear()
+        self._going_back = False
+        self.playlist_url = None
+        self.is_playing = False
+        self._manual_skip = False
+        self.is_loading = False
 
-    async def connect_to_voice(self):
+    async def connect_to_voice(self, channel):
         try:
-            channel = self.bot.get_channel(self.config.voice_channel_id)
             if not isinstance(channel, discord.VoiceChannel):
                 return False
+            self._reconnecting = True
             if self.voice_client:
                 await self.voice_client.disconnect(force=True)
             self.voice_client = await channel.connect(timeout=30.0, reconnect=True)
+            self._leaving = False
             return True
         except Exception as e:
             safe_log_info(f"Ошибка подключения: {e}")
             await asyncio.sleep(5)
             return False
+        finally:
+            # connect() возвращается после ответа шлюза, так что эхо отключения уже обработано
+            self._reconnecting = False
 
-    async def load_playlist(self, url, interaction=None):
+    async def load_playlist(self, url, interaction=None, ready=None):
         self.is_loading = True
 
-        cache_key = self._get_playlist_cache_key(url)
-        cached_data = self._load_from_cache(cache_key) if self.config.cache_enabled else None
+        cache_key = self.cog._get_playlist_cache_key(url)
+        cached = await self._load_cached_version(url, cache_key, ready)
 
         if interaction:
-            msg = await interaction.followup.send("🔍 Проверяем кеш..." if cached_data else "🔍 Загружаем плейлист...")
+            msg = await interaction.followup.send("🔍 Проверяем кеш..." if cached else "🔍 Загружаем плейлист...")
 
         try:
-            if cached_data:
-                self.full_playlist = cached_data['tracks']
+            if cached:
                 if interaction:
                     await msg.edit(content=f"✅ Загружено {len(self.full_playlist)} треков из кеша")
                 return True
 
-            info = await self.run_ydl_extract(url)
-            if not info:
+            # Плоский список: только данные со страниц плейлиста, форматы разрешаются при воспроизведении
+            playlist = self.full_playlist = TrackQueue()
+            last_report = time.monotonic()
+            async with aclosing(self.cog.extractors.iter_entries(url, 'flat')) as entries:
+                async for e in entries:
+                    track = track_from_entry(e)
+                    if not track:
+                        if e and not e.get('is_unavailable'):
+                            safe_log_info(f"Пропущен некорректный трек: {e.get('title')}")
+                        continue
+
+                    playlist.append(track)
+                    if ready and not ready.is_set():
+                        ready.set()
+
+                    if interaction and time.monotonic() - last_report > 5:
+                        last_report = time.monotonic()
+                        try:
+                            await msg.edit(content=f"🔍 Загружено {len(playlist)} треков...")
+                        except discord.HTTPException:
+                            pass
+
+            if not playlist:
                 if interaction:
                     await interaction.followup.send("❌ yt-dlp ничего не вернул")
                 return False
 
-            entries = info.get('entries') or [info]
-            self.full_playlist.clear()
-
-            for e in entries:
-                if not e or e.get('is_unavailable'):
-                    continue
-
-                track_page = e.get('webpage_url') or e.get('url')
-                if not track_page or not track_page.startswith("http"):
-                    safe_log_info(f"Пропущен некорректный трек: {e.get('title')}")
-                    continue
-
-                self.full_playlist.append({
-                    'url': track_page,
-                    'title': e.get('title', 'Без названия'),
-                    'original_url': track_page,
-                    'duration': e.get('duration', 0)
-                })
-
             if self.config.cache_enabled:
-                self._save_to_cache(cache_key, {
+                await asyncio.to_thread(self.cog._save_to_cache, cache_key, {
                     'url': url,
                     'last_updated': datetime.now(timezone.utc).isoformat(),
-                    'tracks': self.full_playlist
+                    'tracks': playlist.to_dicts()
                 })
 
             if interaction:
-                await msg.edit(content=f"✅ Загружено {len(self.full_playlist)} треков")
+                await msg.edit(content=f"✅ Загружено {len(playlist)} треков")
             return True
 
         except Exception as exc:
-            safe_log_info("Ошибка load_playlist", exc_info=True)
+            safe_log_info("Ошибка load_playlist", exc_info=True, guild=self.guild_id, url=url)
             if interaction:
                 await interaction.followup.send(f"❌ Ошибка загрузки: {exc}")
             return False
         finally:
             self.is_loading = False
 
-    async def load_spotify_playlist(self, url, interaction=None):
-        if not self.spotify:
+    async def load_spotify_playlist(self, url, interaction=None, ready=None):
+        if not self.cog.spotify:
             if interaction: await interaction.followup.send("❌ Spotify не настроен")
             return False
 
-        cache_key = self._get_playlist_cache_key(url)
-        cached_data = self._load_from_cache(cache_key) if self.config.cache_enabled else None
-
-        if interaction:
-            msg = await interaction.followup.send(
-                "🔍 Проверяем кеш..." if cached_data else "🔍 Первая загрузка плейлиста, это может занять время...")
+        cache_key = self.cog._get_playlist_cache_key(url)
 
         self.is_loading = True
         try:
-            if cached_data:
-                self.full_playlist = cached_data['tracks']
+            cached = await self._load_cached_version(url, cache_key, ready)
+            if cached:
                 if interaction:
-                    await msg.edit(content=f"✅ Загружено {len(self.full_playlist)} треков из кеша")
+                    await interaction.followup.send(f"✅ Загружено {len(self.full_playlist)} треков из кеша")
                 return True
 
+            if interaction:
+                msg = await interaction.followup.send("🔍 Получаем список треков Spotify...")
+
             playlist_id = url.split('/')[-1].split('?')[0]
-            tracks = []
-            results = self.spotify.playlist_tracks(playlist_id)
-
-            while results:
-                for item in results['items']:
-                    if item.get('track'):
-                        track = item['track']
-                        tracks.append({
-                            'query': f"{track['name']} {track['artists'][0]['name']}",
-                            'spotify_data': {
-                                'id': track['id'],
-                                'name': track['name'],
-                                'artists': [a['name'] for a in track['artists']],
-                                'duration_ms': track['duration_ms']
-                            }
-                        })
-                results = self.spotify.next(results) if results['next'] else None
+            tracks = await self.cog.fetch_spotify_tracks(playlist_id)
 
+            # Ищем только треки, которых еще нет в индексе
+            new_count = sum(1 for item in tracks if not self.cog.track_index.get(item['spotify_data']['id']))
+            safe_log_info(
+                f"Spotify плейлист: {len(tracks)} треков, новых для поиска: {new_count}",
+                guild=self.guild_id, tracks=len(tracks), new=new_count
+            )
             if interaction:
-                await msg.edit(content=f"🔎 Ищем {len(tracks)} треков...")
-
-            self.full_playlist = []
-            batch_size = 5
-            for i in range(0, len(tracks), batch_size):
-                batch = tracks[i:i + batch_size]
-                tasks = [self.run_ydl_extract(f"ytsearch:{item['query']}") for item in batch]
-                batch_results = await asyncio.gather(*tasks)
-
-                for j, res in enumerate(batch_results):
-                    if res and res.get('entries'):
-                        entry = res['entries'][0]
-                        self.full_playlist.append({
-                            'url': entry['url'],
-                            'title': entry['title'],
-                            'original_url': entry.get('original_url', entry['url']),
-                            'spotify_data': batch[j]['spotify_data']
-                        })
-
-                if interaction and i % 10 == 0:
-                    await msg.edit(content=f"✅ Загружено {min(i + batch_size, len(tracks))}/{len(tracks)}")
+                await msg.edit(content=f"🔎 Ищем {new_count} новых треков из {len(tracks)}...")
+
+            # Конвейер без барьеров: воркеры берут следующий трек сразу после предыдущего,
+            # а результаты добавляются в плейлист строго по порядку по мере готовности
+            playlist = self.full_playlist = TrackQueue()
+            queue = asyncio.Queue()
+            for index, item in enumerate(tracks):
+                queue.put_nowait((index, item))
+            resolved = {}
+            next_index = 0
+            done_count = 0
+            last_report = time.monotonic()
+
+            async def worker():
+                nonlocal next_index, done_count, last_report
+                while True:
+                    try:
+                        index, item = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    resolved[index] = await self.cog._resolve_spotify_track(item)
+                    done_count += 1
+
+                    while next_index in resolved:
+                        entry = resolved.pop(next_index)
+                        next_index += 1
+                        if entry:
+                            playlist.append(entry)
+                            if ready and not ready.is_set():
+                                ready.set()
+
+                    if interaction and time.monotonic() - last_report > 5:
+                        last_report = time.monotonic()
+                        try:
+                            await msg.edit(content=f"✅ Загружено {done_count}/{len(tracks)}")
+                        except discord.HTTPException:
+                            pass
+
+            workers = max(1, min(self.config.spotify_concurrency, len(tracks)))
+            try:
+                await asyncio.gather(*(worker() for _ in range(workers)))
+            finally:
+                await self.cog.track_index.flush()
+
+            if interaction:
+                await msg.edit(content=f"✅ Загружено {len(playlist)}/{len(tracks)}")
 
             if self.config.cache_enabled:
-                self._save_to_cache(cache_key, {
+                await asyncio.to_thread(self.cog._save_to_cache, cache_key, {
                     'url': url,
                     'last_updated': datetime.now(timezone.utc).isoformat(),
-                    'tracks': self.full_playlist
+                    'tracks': playlist.to_dicts()
                 })
 
             return True
 
         except Exception as e:
-            safe_log_info(f"Spotify error: {e}")
+            safe_log_info(f"Spotify error: {e}", exc_info=True, guild=self.guild_id, url=url)
             if interaction: await interaction.followup.send("❌ Ошибка загрузки")
             return False
         finally:
             self.is_loading = False
 
-    async def run_ydl_extract(self, query):
-        def _extract():
-            with YoutubeDL(self.ydl_opts) as ydl:
-                return ydl.extract_info(query, download=False)
+    async def _load_cached_version(self, url, cache_key, ready=None):
+        """Ставит сохраненную версию плейлиста (из прогрева или кеша) в пределах CacheTTL.
+
+        Версия старше PlaylistRefreshInterval отдается сразу и ставится на фоновое обновление;
+        старше CacheTTL не отдается вовсе, и плейлист загружается заново. Из кеша сначала
+        читается первая страница, чтобы ready сработал до разбора всего плейлиста.
+        Без кеша есть только копия из прогрева, и она живет PlaylistRefreshInterval.
+        """
+        if not self.config.cache_enabled:
+            preloaded = self.cog.preloaded.get(url)
+            if preloaded and not self.cog.refresher.is_stale(preloaded[0]):
+                return self._set_cached_playlist(TrackQueue(preloaded[1]), ready)
+            self.cog.preloaded.pop(url, None)
+            return None
+        store = self.cog.playlist_store
+        meta = await asyncio.to_thread(store.get_meta, cache_key)
+        preloaded = self.cog.preloaded.get(url)
+        if preloaded:
+            # Копия из прогрева годится, пока в кеше та же версия и CacheTTL не истек
+            if meta and meta['last_updated'] == preloaded[0]:
+                if self.cog.refresher.is_stale(meta['last_updated']):
+                    self.cog.refresher.request(url)
+                return self._set_cached_playlist(TrackQueue(preloaded[1]), ready)
+            self.cog.preloaded.pop(url, None)
+
+        if not meta:
+            # Нет в SQLite: возможно, остался старый JSON кеш, он переносится целиком
+            cached_data = await asyncio.to_thread(self.cog._load_from_cache, cache_key)
+            if not cached_data:
+                return None
+            if self.cog.refresher.is_stale(datetime.fromisoformat(cached_data['last_updated']).timestamp()):
+                self.cog.refresher.request(url)
+            return self._set_cached_playlist(TrackQueue(map(Track.from_dict, cached_data['tracks'])), ready)
+
+        if self.cog.refresher.is_stale(meta['last_updated']):
+            self.cog.refresher.request(url)
+        first = await asyncio.to_thread(store.load_tracks, cache_key, 0, CACHE_FIRST_PAGE)
+        playlist = self._set_cached_playlist(TrackQueue(map(Track.from_dict, first)), ready)
+        if not playlist or meta['track_count'] <= len(first):
+            return playlist
+
+        rest = await asyncio.to_thread(
+            store.load_tracks, cache_key, len(first), version=meta['last_updated']
+        )
+        if rest is None:
+            # Между чтениями кеш перезаписали: берем новую версию целиком, не сбивая текущий трек
+            cached_data = await asyncio.to_thread(self.cog._load_from_cache, cache_key)
+            if cached_data and cached_data['tracks']:
+                self._swap_playlist(TrackQueue(map(Track.from_dict, cached_data['tracks'])))
+            return self.full_playlist
+        for data in rest:
+            playlist.append(Track.from_dict(data))
+        return playlist
+
+    def _set_cached_playlist(self, playlist, ready):
+        self.full_playlist = playlist
+        if ready and playlist:
+            ready.set()
+        return playlist
+
+    def replace_playlist(self, tracks):
+        """Подменяет плейлист новой версией, не сбивая текущий трек и позицию"""
+        if self.is_loading or not tracks:
+            return False
+        self._swap_playlist(TrackQueue(tracks))
+        return True
+
+    def _swap_playlist(self, tracks):
+        if self.full_playlist.shuffled:
+            # Сохраняем перемешанный порядок, новые треки добавляем в конец в случайном порядке
+            free = {}
+            for index, track in enumerate(tracks.tracks):
+                free.setdefault(track.url, deque()).append(index)
+            order = array('I')
+            for track in self.full_playlist:
+                if free.get(track.url):
+                    order.append(free[track.url].popleft())
+            added = [index for indices in free.values() for index in indices]
+            random.shuffle(added)
+            order.extend(added)
+            tracks.order = order
+
+        position = self.current_position
+        current = self.current_song
+        if current:
+            matches = [i for i, track in enumerate(tracks) if track.url == current.url]
+            if matches:
+                position = min(matches, key=lambda i: abs(i - self.current_position))
+            else:
+                # Текущий трек удалили из плейлиста: доигрываем его, дальше идет новая версия
+                position = min(position, len(tracks))
+                tracks.insert(position, current)
+        else:
+            position = min(position, len(tracks) - 1)
+
+        # Без await между присваиваниями: after_play видит либо старую, либо новую версию
+        self.full_playlist = tracks
+        self.current_position = position
+        self._refresh_lookahead(position + 1 if current else position)
+
+    async def _start_loading(self, url, interaction, wait_full=False):
+        """Запускает загрузку плейлиста в фоне и ждет первого готового трека"""
+        loader = self.load_spotify_playlist if "spotify.com" in url else self.load_playlist
+        # Новый плейлист важнее восстановления старого после обрыва
+        if self._recover_task and not self._recover_task.done():
+            self._recover_task.cancel()
+        self.playlist_url = url
+        ready = asyncio.Event()
+        self._load_task = asyncio.create_task(loader(url, interaction, ready))
+
+        if not wait_full:
+            ready_wait = asyncio.create_task(ready.wait())
+            await asyncio.wait({self._load_task, ready_wait}, return_when=asyncio.FIRST_COMPLETED)
+            ready_wait.cancel()
+            if ready.is_set():
+                return True
 
-        return await asyncio.get_running_loop().run_in_executor(None, _extract)
+        try:
+            return await self._load_task and bool(self.full_playlist)
+        except asyncio.CancelledError:
+            return False
+
+    def _refresh_lookahead(self, start):
+        """Пересчитывает окно предзагрузки начиная с позиции start"""
+        wanted = []
+        if self.full_playlist:
+            depth = min(self.config.lookahead_tracks, len(self.full_playlist))
+            for offset in range(depth):
+                track = self.full_playlist[(start + offset) % len(self.full_playlist)]
+                if track.url not in wanted:
+                    wanted.append(track.url)
+
+        # Отменяем задачи, которые вышли из окна (skip, goto, random)
+        for url in list(self._lookahead):
+            if url not in wanted:
+                self._lookahead.pop(url).cancel()
+
+        for url in wanted:
+            if url not in self._lookahead:
+                self._lookahead[url] = asyncio.create_task(self.cog._resolve_stream(url, 'lookahead'))
+
+    def _clear_lookahead(self):
+        for task in self._lookahead.values():
+            task.cancel()
+        self._lookahead.clear()
+
+    async def _take_stream(self, track):
+        """Возвращает поток трека, используя предзагрузку если она есть"""
+        task = self._lookahead.pop(track.url, None)
+        if task:
+            try:
+                stream = await task
+                if stream:
+                    return stream
+            except Exception as e:
+                safe_log_info(f"Ошибка предзагрузки: {e}")
+        return await self.cog._resolve_stream(track.url, 'play')
+
+    @staticmethod
+    def _is_expired_stream_failure(error, played_seconds):
+        """ffmpeg падает сразу (обычно 403), если ссылка из кеша уже протухла"""
+        if error and '403' in str(error):
+            return True
+        return played_seconds < 3
 
     async def play_next(self, error=None):
         if error:
             safe_log_info(f"Ошибка: {error}")
 
+        wait_started = time.perf_counter()
         async with self._play_lock:
+            metrics.observe('play_next_lock_wait_seconds', time.perf_counter() - wait_started)
             if self.voice_client and self.voice_client.is_playing():
                 self.voice_client.stop()
-
-            await asyncio.sleep(0.5)
+                # Даем потоку плеера завершиться
+                await asyncio.sleep(0)
 
             if not self.voice_client or not self.voice_client.is_connected():
                 self.is_playing = False
@@ -367,7 +2108,7 @@ class MusicCog(commands.Cog):
                 return
 
             try:
-                self.current_song = self.full_playlist[self.current_position]
+                self._set_current_song(self.full_playlist[self.current_position])
                 asyncio.create_task(self._play_current_track())
 
             except Exception as e:
@@ -377,78 +2118,877 @@ class MusicCog(commands.Cog):
 
     async def _play_current_track(self):
         try:
-            original_flat = self.ydl_opts.get("extract_flat", False)
-            original_force_generic = self.ydl_opts.get("force_generic_extractor", True)
-            self.ydl_opts["extract_flat"] = False
-            self.ydl_opts["force_generic_extractor"] = False
-
-            info = await self.run_ydl_extract(self.current_song['original_url'])
-
-            self.ydl_opts["extract_flat"] = original_flat
-            self.ydl_opts["force_generic_extractor"] = original_force_generic
-
-            if not info:
+            track = self.current_song
+            offset, self._resume_offset = self._resume_offset, 0
+            resolve_started = time.perf_counter()
+            stream = await self._take_stream(track)
+            resolve_ms = round((time.perf_counter() - resolve_started) * 1000, 1)
+
+            if not stream:
+                safe_log_info(f"❌ Не удалось получить аудио URL: {track.title}",
+                              guild=self.guild_id, track=track.url)
                 await self._increment_position()
                 return await self.play_next()
+            audio_url = stream['url']
+
+            # Полный URL содержит подписи доступа, в лог пишем только источник
+            origin = "локальный файл" if stream.get('local') else urlparse(audio_url).hostname
+            safe_log_info(
+                f"▶️ Трек: {track.title} ({origin})" + (f" с {offset:.0f} сек" if offset else ""),
+                guild=self.guild_id, track=track.url, position=self.current_position,
+                resolve_ms=resolve_ms, cached=stream['cached'], local=bool(stream.get('local')), offset=offset
+            )
 
-            audio_url = None
-            if 'formats' in info:
-                for f in info['formats']:
-                    if f.get('acodec') != 'none' and f.get('url', '').startswith("http"):
-                        audio_url = f['url']
-                        break
-
-            if not audio_url:
-                audio_url = info.get('url')
-
-            if not audio_url:
-                safe_log_info(f"❌ Недопустимый аудио URL: {audio_url}")
-                await self._increment_position()
-                return await self.play_next()
-
-            ffmpeg_options = {
-                'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-                'options': '-vn',
-                'executable': self.config.ffmpeg_path
-            }
-
-            safe_log_info(f"▶️ Трек: {self.current_song['title']}")
-            safe_log_info(f"▶️ URL для ffmpeg: {audio_url}")
-
-            source = discord.FFmpegOpusAudio(audio_url, **ffmpeg_options)
+            source = self._open_source(track, stream, offset)
+            if not offset:
+                self.cog.note_track_played(track)
+            metrics.inc('tracks_started_total', source='local' if stream.get('local') else 'remote')
+            gapless = self._gapless = GaplessSource(
+                source, self._on_gapless_advance, int(self.config.crossfade_seconds * FRAMES_PER_SECOND)
+            )
 
             def after_play(error):
-                if not self._manual_skip:
-                    asyncio.run_coroutine_threadsafe(self._increment_position(), self.bot.loop)
-                self._manual_skip = False
-                asyncio.run_coroutine_threadsafe(self.play_next(error), self.bot.loop)
+                # Поток плеера: только замеры, разбор окончания идет в event loop
+                self._track_ended_at = time.perf_counter()
+                played_seconds = time.monotonic() - gapless.current.started_at
+                asyncio.run_coroutine_threadsafe(self._after_track(gapless, error, played_seconds), self.bot.loop)
 
             self.is_playing = True
-            self.voice_client.play(source, after=after_play)
+            self.voice_client.play(gapless, after=after_play)
+            self._refresh_lookahead(self.current_position + 1)
+            self._schedule_prepare(gapless)
 
         except Exception as e:
-            safe_log_info(f"❌ Ошибка воспроизведения: {e}")
+            safe_log_info(f"❌ Ошибка воспроизведения: {e}", exc_info=True, guild=self.guild_id)
             await self._increment_position()
             await self.play_next()
 
+    async def _after_track(self, gapless, error, played_seconds):
+        """Окончание трека. Выполняется в event loop: кеш ссылок и состояние сессии
+        не меняются из потока плеера"""
+        # После бесшовных переходов играет уже не тот трек, с которого начинали
+        active = gapless.current
+        if (active.stream['cached'] and not self._manual_skip
+                and self._is_expired_stream_failure(error, played_seconds)):
+            # Ссылка из кеша не сработала: повторяем тот же трек со свежим извлечением
+            safe_log_info(f"Ссылка из кеша недействительна, извлекаем заново: {active.track.title}")
+            self.cog.stream_cache.invalidate(active.track.url)
+            self._resume_offset = active.offset
+            await self.play_next()
+            return
+        if not self._manual_skip and active.ended_early and self._resume_count < self.config.resume_attempts:
+            # Поток оборвался посреди трека: извлекаем ссылку заново и продолжаем с того же места
+            self._resume_count += 1
+            safe_log_info(
+                f"Поток оборвался на {active.position:.0f} сек, продолжаем: {active.track.title}",
+                guild=self.guild_id, track=active.track.url, attempt=self._resume_count
+            )
+            metrics.inc('playback_resumes_total', reason='stream')
+            self.cog.stream_cache.invalidate(active.track.url)
+            self._resume_offset = active.position
+            await self.play_next()
+            return
+        if not self._manual_skip:
+            await self._increment_position()
+        self._manual_skip = False
+        await self.play_next(error)
+
+    def _open_source(self, track, stream, offset=0):
+        """Запускает ffmpeg для трека (с секунды offset) и начинает заполнять буфер кадров"""
+        gain = self.cog.loudness.gain_for(track.url)
+        if gain is None:
+            self.cog.loudness.request(track.url, stream)
+        if self.cog.loudnorm_target:
+            metrics.inc('loudness_tracks_total', mode='live' if gain is None else 'static')
+        ffmpeg_options = self.cog.ffmpeg_source_options(stream, offset, gain)
+        if self.config.crossfade_seconds:
+            # Для наложения треков нужен PCM: Opus кадры смешать нельзя
+            ffmpeg_options.pop('codec')
+            ffmpeg = discord.FFmpegPCMAudio(stream['url'], **ffmpeg_options)
+        else:
+            if ffmpeg_options['codec'] == 'copy':
+                safe_log_info("▶️ Opus без перекодирования")
+            ffmpeg = discord.FFmpegOpusAudio(stream['url'], **ffmpeg_options)
+        return PrebufferedSource(
+            ffmpeg, track, stream,
+            int(self.config.prebuffer_seconds * FRAMES_PER_SECOND),
+            self._note_first_packet,
+            offset
+        )
+
+    def _schedule_prepare(self, gapless):
+        if self._prepare_task and not self._prepare_task.done():
+            self._prepare_task.cancel()
+        self._prepare_task = None
+        if self.config.gapless_playback:
+            self._prepare_task = asyncio.create_task(self._prepare_next(gapless))
+
+    async def _prepare_next(self, gapless):
+        """Незадолго до конца трека открывает ffmpeg следующего, чтобы переход был без паузы"""
+        try:
+            track = gapless.current.track
+            duration = gapless.current.stream.get('duration') or track.duration
+            if not duration:
+                # Длительность неизвестна (прямые эфиры, часть плоских записей): открыть ffmpeg
+                # заранее значит держать пустое соединение весь трек, следующий запустится обычным путем
+                return
+            # Раньше не открываем: держать соединение ради пары секунд буфера незачем.
+            # После возобновления трек играет не с начала, а с offset
+            elapsed = gapless.current.offset + time.monotonic() - gapless.current.started_at
+            delay = duration - self.config.prepare_ahead_seconds - elapsed
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self._gapless is not gapless or not self.full_playlist:
+                return
+
+            next_track = self.full_playlist[(self.current_position + 1) % len(self.full_playlist)]
+            stream = await self._take_stream(next_track)
+            # Пока извлекали, могли переключить трек (/skip, /goto) или остановить плеер
+            if not stream or self._gapless is not gapless or self.current_song is not track:
+                return
+            gapless.set_next(self._open_source(next_track, stream))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            safe_log_info(f"Ошибка подготовки следующего трека: {e}", guild=self.guild_id)
+
+    def _on_gapless_advance(self, finished, following):
+        """Вызывается из потока плеера, когда поток перешел на следующий трек"""
+        self._track_ended_at = time.perf_counter()
+        following.started_at = time.monotonic()
+        asyncio.run_coroutine_threadsafe(self._advance_to(following), self.bot.loop)
+
+    async def _advance_to(self, source):
+        await self._increment_position()
+        track = source.track
+        if self.full_playlist and self.full_playlist[self.current_position].url != track.url:
+            # Плейлист успели обновить: ищем трек в новой версии
+            for i, candidate in enumerate(self.full_playlist):
+                if candidate.url == track.url:
+                    self.current_position = i
+                    break
+        self._set_current_song(track)
+        self.cog.note_track_played(track)
+        metrics.inc('tracks_started_total', source='local' if source.stream.get('local') else 'remote')
+        safe_log_info(
+            f"▶️ Трек: {track.title} (без паузы)",
+            guild=self.guild_id, track=track.url, position=self.current_position, gapless=True
+        )
+        self._refresh_lookahead(self.current_position + 1)
+        if self._gapless is not None and self._gapless.current is source:
+            self._schedule_prepare(self._gapless)
+
+    def _set_current_song(self, track):
+        """Меняет текущий трек, запоминая предыдущий для /back (кроме перехода назад)"""
+        previous = self.current_song
+        if previous is not None and previous is not track and not self._going_back:
+            self.history.append(previous)
+        if previous is not track:
+            self._resume_count = 0
+        self._going_back = False
+        self.current_song = track
+
+    def playback_offset(self):
+        """Сколько секунд текущего трека уже проиграно"""
+        gapless = self._gapless
+        if gapless is None or self.current_song is None or gapless.current.track is not self.current_song:
+            return 0
+        return gapless.current.position
+
+    def snapshot(self):
+        """Состояние, из которого можно продолжить воспроизведение без повторной загрузки плейлиста"""
+        if self.current_song is None or not self.full_playlist:
+            return None
+        return {
+            'playlist': self.full_playlist,
+            'playlist_url': self.playlist_url,
+            'track': self.current_song,
+            'position': self.current_position,
+            'offset': self.playback_offset()
+        }
+
+    def restore(self, snapshot):
+        """Возвращает очередь и позицию из снимка; трек ищется рядом с сохраненной позицией"""
+        playlist, track = snapshot['playlist'], snapshot['track']
+        matches = [i for i, candidate in enumerate(playlist) if candidate.url == track.url]
+        if not matches:
+            return False
+        self.full_playlist = playlist
+        self.playlist_url = snapshot['playlist_url']
+        self.current_position = min(matches, key=lambda i: abs(i - snapshot['position']))
+        self._resume_offset = snapshot['offset']
+        return True
+
+    def _replaced(self, snapshot):
+        """После снимка загрузили другой плейлист: восстанавливать старый уже нельзя"""
+        return self.full_playlist is not snapshot['playlist'] or self.playlist_url != snapshot['playlist_url']
+
+    def on_disconnected(self, channel):
+        """Голосовое подключение потеряно не по команде: запоминаем место и переподключаемся"""
+        if self._reconnecting:
+            return
+        snapshot = self.snapshot()
+        self.voice_client = None
+        self.is_playing = False
+        self.current_song = None
+        if self._leaving or not self.config.auto_resume or snapshot is None or channel is None:
+            return
+        if self._recover_task and not self._recover_task.done():
+            self._recover_task.cancel()
+        self._recover_task = asyncio.create_task(self._recover(channel, snapshot))
+
+    async def _recover(self, channel, snapshot):
+        for attempt in range(self.config.resume_attempts):
+            await asyncio.sleep(min(2 ** attempt, 30))
+            if self._leaving or self.is_playing or self._replaced(snapshot):
+                return
+            connected = self.voice_client and self.voice_client.is_connected()
+            if connected or await self.connect_to_voice(channel):
+                break
+        else:
+            safe_log_info("Не удалось переподключиться, воспроизведение остановлено", guild=self.guild_id)
+            return
+
+        if self._replaced(snapshot) or not self.restore(snapshot):
+            return
+        metrics.inc('playback_resumes_total', reason='voice')
+        safe_log_info(
+            f"Переподключились, продолжаем {snapshot['track'].title} с {snapshot['offset']:.0f} сек",
+            guild=self.guild_id, track=snapshot['track'].url, offset=snapshot['offset']
+        )
+        await self.play_next()
+
+    def _order_changed(self):
+        """Порядок воспроизведения изменился: пересчитываем предзагрузку и следующий трек"""
+        self._refresh_lookahead(self.current_position + 1 if self.is_playing else self.current_position)
+        if self._gapless is not None:
+            stale = self._gapless._take_next()
+            if stale:
+                stale.cleanup()
+            self._schedule_prepare(self._gapless)
+
+    def _note_first_packet(self, now):
+        """Вызывается из потока плеера на первом пакете: пауза после прошлого трека"""
+        ended_at, self._track_ended_at = self._track_ended_at, None
+        if ended_at is not None:
+            metrics.observe('track_gap_seconds', now - ended_at)
+
     async def _increment_position(self):
         if self.current_position < len(self.full_playlist) - 1:
             self.current_position += 1
         else:
             self.current_position = 0
 
+
+class PlaylistSearchModal(discord.ui.Modal, title="Поиск в плейлисте"):
+    query = discord.ui.TextInput(label="Название или исполнитель", required=False, max_length=100)
+
+    def __init__(self, playlist_view):
+        super().__init__()
+        self.playlist_view = playlist_view
+        self.query.default = playlist_view.query
+
+    async def on_submit(self, interaction: discord.Interaction):
+        self.playlist_view.apply_search(self.query.value)
+        await self.playlist_view.refresh(interaction)
+
+
+class PlaylistView(discord.ui.View):
+    """Постраничный просмотр плейлиста в одном сообщении: строки страницы собираются при показе"""
+
+    PAGE_SIZE = 15
+    TITLE_LIMIT = 90
+
+    def __init__(self, player, owner_id, timeout=300):
+        super().__init__(timeout=timeout)
+        self.player = player
+        self.owner_id = owner_id
+        self.message = None
+        self.page = player.current_position // self.PAGE_SIZE if player.is_playing else 0
+        self.query = ''
+        # Индексы треков, подходящих под поиск; None - без фильтра
+        self.matches = None
+
+    def _total(self):
+        return len(self.matches) if self.matches is not None else len(self.player.full_playlist)
+
+    def _page_count(self):
+        return max(1, -(-self._total() // self.PAGE_SIZE))
+
+    def apply_search(self, query):
+        self.query = query.strip()
+        needle = self.query.lower()
+        self.matches = [
+            i for i, track in enumerate(self.player.full_playlist) if needle in track.title.lower()
+        ] if needle else None
+        self.page = 0
+
+    def render(self):
+        playlist = self.player.full_playlist
+        self.page = min(self.page, self._page_count() - 1)
+        start = self.page * self.PAGE_SIZE
+        if self.matches is not None:
+            indices = self.matches[start:start + self.PAGE_SIZE]
+            header = f"**Плейлист:** найдено {len(self.matches)} по запросу «{self.query}»"
+        else:
+            indices = range(start, min(start + self.PAGE_SIZE, len(playlist)))
+            header = f"**Плейлист:** {len(playlist)} треков"
+        lines = [f"{header}, стр. {self.page + 1}/{self._page_count()}"]
+        for i in indices:
+            if i >= len(playlist):
+                continue
+            title = playlist[i].title
+            if len(title) > self.TITLE_LIMIT:
+                title = title[:self.TITLE_LIMIT - 1] + "…"
+            prefix = "▶️ " if i == self.player.current_position and self.player.is_playing else ""
+            # В перемешанном порядке показываем и исходный номер: по нему работает /goto original
+            suffix = f" (#{playlist.original_index(i) + 1})" if playlist.shuffled else ""
+            lines.append(f"{i + 1}. {prefix}{title}{suffix}")
+        if len(lines) == 1:
+            lines.append("Ничего не найдено" if self.matches is not None else "Пусто")
+        self._update_buttons()
+        return "\n".join(lines)
+
+    def _update_buttons(self):
+        last = self._page_count() - 1
+        self.first_page.disabled = self.prev_page.disabled = self.page == 0
+        self.next_page.disabled = self.last_page.disabled = self.page >= last
+        self.clear_search.disabled = self.matches is None
+
+    async def refresh(self, interaction):
+        await interaction.response.edit_message(content=self.render(), view=self)
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        if interaction.user.id != self.owner_id:
+            await interaction.response.send_message("Откройте свой список командой /playlist", ephemeral=True)
+            return False
+        return True
+
+    async def on_timeout(self):
+        for item in self.children:
+            item.disabled = True
+        if self.message:
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException:
+                pass
+
+    @discord.ui.button(emoji="⏮️", style=discord.ButtonStyle.secondary)
+    async def first_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page = 0
+        await self.refresh(interaction)
+
+    @discord.ui.button(emoji="◀️", style=discord.ButtonStyle.secondary)
+    async def prev_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page = max(0, self.page - 1)
+        await self.refresh(interaction)
+
+    @discord.ui.button(emoji="▶️", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page += 1
+        await self.refresh(interaction)
+
+    @discord.ui.button(emoji="⏭️", style=discord.ButtonStyle.secondary)
+    async def last_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page = self._page_count() - 1
+        await self.refresh(interaction)
+
+    @discord.ui.button(label="Текущий", emoji="🎯", style=discord.ButtonStyle.primary, row=1)
+    async def jump_to_current(self, interaction: discord.Interaction, button: discord.ui.Button):
+        # Текущий трек виден только без фильтра
+        self.matches = None
+        self.query = ''
+        self.page = self.player.current_position // self.PAGE_SIZE
+        await self.refresh(interaction)
+
+    @discord.ui.button(label="Поиск", emoji="🔍", style=discord.ButtonStyle.secondary, row=1)
+    async def search(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.send_modal(PlaylistSearchModal(self))
+
+    @discord.ui.button(label="Сбросить поиск", style=discord.ButtonStyle.secondary, row=1)
+    async def clear_search(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.apply_search('')
+        await self.refresh(interaction)
+
+
+class MusicCog(commands.Cog):
+    SPOTIFY_PAGE_SIZE = 100
+    SPOTIFY_MAX_ATTEMPTS = 5
+    # Только поля, которые нужны для поиска: страница в несколько раз меньше полной
+    SPOTIFY_PAGE_FIELDS = 'total,items(track(id,name,duration_ms,artists(name)))'
+
+    def __init__(self, bot, config):
+        self.bot = bot
+        self.config = config
+        self.bot_start_time = datetime.now(timezone.utc)
+        self.retry_count = 0
+        # Сессии воспроизведения по серверам; пул извлечения и кеши общие для всех
+        self.players = {}
+        self._init_ytdl()
+        self.extractors = ExtractorPool(
+            self.ydl_opts,
+            self.config.play_extractor_workers,
+            self.config.bulk_extractor_workers,
+            use_processes=self.config.extractor_mode == 'process',
+            process_max_tasks=self.config.extractor_process_max_tasks
+        )
+        # Профиль для извлечения аудио потока конкретного трека с форматом из конфига
+        self.extractors.add_profile(
+            'stream', extract_flat=False, force_generic_extractor=False, format=self.config.ydl_format
+        )
+        # Профиль для дешевого перечисления плейлиста без разрешения форматов
+        self.extractors.add_profile(
+            'flat', extract_flat='in_playlist', lazy_playlist=True,
+            force_generic_extractor=False, noplaylist=False
+        )
+        # Поиск для Spotify: только список кандидатов, формат разрешается при воспроизведении
+        self.extractors.add_profile(
+            'search', extract_flat='in_playlist', force_generic_extractor=False, noplaylist=False
+        )
+        self.ffmpeg_before_options, self.ffmpeg_output_options, self.ffmpeg_filters = \
+            split_ffmpeg_options(self.config.ffmpeg_options)
+        # Цели loudnorm из настроек: по ним считается постоянное усиление для замеренных треков
+        _, self.loudnorm_target = replace_loudnorm(self.ffmpeg_filters)
+        # Клиент Spotify создается при первом Spotify плейлисте
+        self._spotify = None
+        self._ensure_cache_dir()
+        self.stream_cache = StreamUrlCache(
+            self.config.stream_cache_size,
+            Path(self.config.cache_dir) / "stream_urls.json" if self.config.stream_cache_persist else None
+        )
+
+        self.track_index = SpotifyTrackIndex(
+            Path(self.config.cache_dir) / "spotify_index.json" if self.config.cache_enabled else None
+        )
+        self._metrics_server = None
+        self.refresher = PlaylistRefresher(self)
+        self.loudness = LoudnessAnalyzer(self)
+        # Плейлисты из настроек, загруженные прогревом: url -> (версия в кеше, список Track)
+        self.preloaded = {}
+        self.warmup_status = None
+        self._warmup_task = None
+
+        self.audio_cache = None
+        self._audio_fill_queue = asyncio.Queue()
+        self._audio_fill_task = None
+        if self.config.audio_cache_enabled:
+            audio_dir = Path(self.config.cache_dir) / "audio"
+            self.audio_cache = AudioFileCache(
+                audio_dir,
+                self.config.audio_cache_max_bytes,
+                self.config.audio_cache_hot_plays,
+                self.config.audio_cache_policy
+            )
+            # Скачиваем сразу Ogg/Opus, чтобы при воспроизведении не перекодировать
+            self.extractors.add_profile(
+                'download', extract_flat=False, force_generic_extractor=False,
+                format='bestaudio[acodec=opus]/bestaudio/best',
+                outtmpl=str(audio_dir / '%(extractor)s-%(id)s.%(ext)s'),
+                ffmpeg_location=self.config.ffmpeg_path,
+                postprocessors=[{'key': 'FFmpegExtractAudio', 'preferredcodec': 'opus'}]
+            )
+
+    async def cog_load(self):
+        if self.audio_cache:
+            self._audio_fill_task = asyncio.create_task(self._audio_fill_worker())
+        self._register_gauges()
+        self.refresher.start()
+        await self.loudness.start()
+        if self.config.metrics_port:
+            try:
+                self._metrics_server = await metrics.serve(self.config.metrics_host, self.config.metrics_port)
+                safe_log_info(f"Метрики: http://{self.config.metrics_host}:{self.config.metrics_port}/metrics")
+            except OSError as e:
+                safe_log_info(f"Не удалось запустить сервер метрик: {e}")
+
+    def _register_gauges(self):
+        lanes = (ExtractorPool.PLAY, ExtractorPool.BULK)
+        metrics.gauge('extractor_queue_depth', lambda: {
+            (('lane', lane),): self.extractors.queue_depth(lane) for lane in lanes
+        })
+        metrics.gauge('cache_hit_ratio', lambda: {
+            (('cache', name),): round(hits / (hits + misses), 4) if hits + misses else 0
+            for name, (hits, misses) in self._cache_hits().items()
+        })
+        metrics.gauge('active_players', lambda: {
+            (): sum(1 for player in self.players.values() if player.is_playing)
+        })
+        metrics.gauge('warmup_ready', lambda: {
+            (): int(self._warmup_task is not None and self._warmup_task.done())
+        })
+
+    def _cache_hits(self):
+        """{имя кеша: (попадания, промахи)}"""
+        caches = {'stream': (self.stream_cache.hits, self.stream_cache.misses)}
+        if self.audio_cache:
+            caches['audio'] = (self.audio_cache.hits, self.audio_cache.misses)
+        return caches
+
+    def cog_unload(self):
+        for player in self.players.values():
+            player.clear()
+        if self._audio_fill_task:
+            self._audio_fill_task.cancel()
+        if self._metrics_server:
+            self._metrics_server.close()
+        self.refresher.stop()
+        self.loudness.stop()
+        if self._warmup_task:
+            self._warmup_task.cancel()
+        self.stream_cache.save()
+        self.track_index.save()
+        if self.playlist_store:
+            self.playlist_store.close()
+        self.extractors.shutdown()
+
+    @property
+    def spotify(self):
+        if self._spotify is None and self.config.spotify_client_id and self.config.spotify_client_secret:
+            import requests
+            import spotipy
+            from spotipy.oauth2 import SpotifyClientCredentials
+            from urllib3.util.retry import Retry
+
+            # Общий пул соединений на все параллельные запросы страниц;
+            # 429 не повторяем здесь, чтобы не спать в потоке (см. _spotify_call)
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=max(10, self.config.spotify_page_concurrency),
+                max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504))
+            )
+            session.mount('https://', adapter)
+            self._spotify = spotipy.Spotify(
+                auth_manager=SpotifyClientCredentials(
+                    client_id=self.config.spotify_client_id,
+                    client_secret=self.config.spotify_client_secret,
+                    requests_session=session
+                ),
+                requests_session=session
+            )
+        return self._spotify
+
+    @spotify.setter
+    def spotify(self, client):
+        self._spotify = client
+
+    def get_player(self, guild_id):
+        player = self.players.get(guild_id)
+        if player is None:
+            player = self.players[guild_id] = GuildPlayer(self, guild_id)
+        return player
+
+    def _voice_channel_for(self, guild, member=None):
+        """Настроенный канал, если он на этом сервере, иначе канал пользователя"""
+        channel = self.bot.get_channel(self.config.voice_channel_id) if self.config.voice_channel_id else None
+        if isinstance(channel, discord.VoiceChannel) and channel.guild.id == guild.id:
+            return channel
+        if member and member.voice and isinstance(member.voice.channel, discord.VoiceChannel):
+            return member.voice.channel
+        return None
+
+    async def connect_player(self, interaction):
+        player = self.get_player(interaction.guild_id)
+        channel = self._voice_channel_for(interaction.guild, interaction.user)
+        return await player.connect_to_voice(channel)
+
+    def _ensure_cache_dir(self):
+        if self.config.cache_enabled and not Path(self.config.cache_dir).exists():
+            Path(self.config.cache_dir).mkdir(parents=True, exist_ok=True)
+        self.playlist_store = PlaylistCacheStore(
+            Path(self.config.cache_dir) / "cache.sqlite3",
+            self.config.cache_ttl,
+            self.config.cache_max_bytes
+        ) if self.config.cache_enabled else None
+
+    def _get_playlist_cache_key(self, playlist_url):
+        return hashlib.md5(playlist_url.encode()).hexdigest()
+
+    def _load_from_cache(self, cache_key, allow_stale=False):
+        data = self.playlist_store.load(cache_key, allow_stale)
+        if data:
+            return data
+
+        # Переносим старый JSON кеш в SQLite при первом обращении
+        legacy_file = Path(self.config.cache_dir) / f"{cache_key}.json"
+        if legacy_file.exists():
+            with open(legacy_file, 'r', encoding='utf-8') as f:
+                legacy = json.load(f)
+            self.playlist_store.save(cache_key, legacy['url'], legacy['tracks'])
+            legacy_file.unlink()
+            return self.playlist_store.load(cache_key, allow_stale)
+        return None
+
+    def _save_to_cache(self, cache_key, data):
+        self.playlist_store.save(cache_key, data['url'], data['tracks'])
+
+    def _init_ytdl(self):
+        self.ydl_opts = {
+            'format': 'bestaudio/best',
+            'quiet': True,
+            'no_warnings': False,
+            'default_search': 'auto',
+            'ignoreerrors': True,
+            'extract_flat': False,
+            'live_from_start': True,
+            'cachedir': False,
+            'force_generic_extractor': True,
+            'socket_timeout': 30,
+            'noplaylist': True,
+            'source_address': '0.0.0.0',
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': self.config.ydl_audio_format,
+                'preferredquality': self.config.ydl_quality,
+            }],
+            'http_headers': {'User-Agent': self.config.ydl_user_agent},
+            'mark_watched': self.config.ydl_mark_watched,
+            'throttledratelimit': self.config.ydl_throttled_rate,
+        }
+        if os.path.exists(self.config.ydl_cookie_file):
+            self.ydl_opts['cookiefile'] = self.config.ydl_cookie_file
+
+    async def run_ydl_extract(self, query, profile='default', lane=ExtractorPool.BULK, caller=None):
+        return await self.extractors.extract(query, profile, lane, caller=caller)
+
+    async def remember_preloaded(self, url, tracks):
+        """Держит плейлист в памяти вместе с версией кеша, которую он повторяет.
+
+        Без кеша версией служит время загрузки, по нему копия и устаревает.
+        """
+        if not self.playlist_store:
+            self.preloaded[url] = (time.time(), tracks)
+            return
+        meta = await asyncio.to_thread(self.playlist_store.get_meta, self._get_playlist_cache_key(url))
+        if meta:
+            self.preloaded[url] = (meta['last_updated'], tracks)
+        else:
+            self.preloaded.pop(url, None)
+
+    def start_warm_up(self):
+        """Запускает прогрев один раз: on_ready после переподключения к шлюзу его не повторяет"""
+        if self.config.warm_up and self._warmup_task is None:
+            self._warmup_task = asyncio.create_task(self.warm_up())
+
+    async def warm_up(self):
+        """Загружает плейлисты из настроек в память и заранее извлекает потоки первых треков,
+        чтобы первый /play после перезапуска сразу начинал звук"""
+        started = time.perf_counter()
+        self.warmup_status = "идет"
+        playlists = tracks = resolved = 0
+        for name, url in self.config.playlist_urls.items():
+            if not url or not url.startswith("http"):
+                continue
+            # Загрузчик без сервера: те же пути загрузки и кеширования, что и у сессий
+            loader = GuildPlayer(self, None)
+            load = loader.load_spotify_playlist if "spotify.com" in url else loader.load_playlist
+            if not await load(url) or not loader.full_playlist:
+                safe_log_info(f"Прогрев: не удалось загрузить плейлист {name}", url=url)
+                continue
+            await self.remember_preloaded(url, loader.full_playlist.tracks)
+            first = loader.full_playlist.tracks[:self.config.warm_up_tracks]
+            streams = await asyncio.gather(
+                *(self._resolve_stream(track.url, 'warmup') for track in first), return_exceptions=True
+            )
+            playlists += 1
+            tracks += len(loader.full_playlist)
+            resolved += sum(1 for stream in streams if stream and not isinstance(stream, BaseException))
+
+        elapsed = time.perf_counter() - started
+        metrics.observe('warmup_seconds', elapsed)
+        self.warmup_status = f"{playlists} плейлистов, {tracks} треков, {resolved} потоков за {elapsed:.1f} с"
+        safe_log_info(
+            f"Прогрев завершен: {self.warmup_status}",
+            playlists=playlists, tracks=tracks, resolved=resolved, warmup_s=round(elapsed, 3)
+        )
+
+    def note_track_played(self, track):
+        """Ставит трек в фоновую загрузку на диск, когда он становится популярным"""
+        if self.audio_cache and self.audio_cache.record_play(track.url):
+            self._audio_fill_queue.put_nowait(track.url)
+
+    async def _audio_fill_worker(self):
+        """Фоновое заполнение аудио кеша по одному треку, чтобы не мешать воспроизведению"""
+        while True:
+            page_url = await self._audio_fill_queue.get()
+            try:
+                info = await self.extractors.extract(
+                    page_url, 'download', ExtractorPool.BULK, download=True, caller='audio_fill'
+                )
+                downloads = (info or {}).get('requested_downloads') or []
+                if downloads and downloads[0].get('filepath'):
+                    self.audio_cache.add(page_url, downloads[0]['filepath'])
+                    await self.audio_cache.flush()
+                    safe_log_info(f"Трек сохранен в аудио кеш: {info.get('title')}")
+                else:
+                    self.audio_cache.discard(page_url)
+            except Exception as e:
+                self.audio_cache.discard(page_url)
+                safe_log_info(f"Ошибка заполнения аудио кеша: {e}")
+
+    async def _spotify_call(self, method, *args, **kwargs):
+        """Вызывает spotipy в потоке; на 429 ждет Retry-After, не занимая поток"""
+        for attempt in range(self.SPOTIFY_MAX_ATTEMPTS):
+            try:
+                return await asyncio.to_thread(method, *args, **kwargs)
+            except Exception as e:
+                status = getattr(e, 'http_status', None)
+                if status != 429 or attempt == self.SPOTIFY_MAX_ATTEMPTS - 1:
+                    raise
+                retry_after = (getattr(e, 'headers', None) or {}).get('Retry-After')
+                delay = float(retry_after) if retry_after else 2 ** attempt
+                metrics.inc('spotify_rate_limited_total')
+                safe_log_info(f"Spotify 429, повтор через {delay:.1f} с")
+                await asyncio.sleep(delay + random.uniform(0, 0.5))
+
+    async def fetch_spotify_tracks(self, playlist_id):
+        """Список треков плейлиста: первая страница дает total, остальные грузятся параллельно"""
+        started = time.perf_counter()
+        client = self.spotify
+        page_size = self.SPOTIFY_PAGE_SIZE
+
+        def fetch_page(offset):
+            return self._spotify_call(
+                client.playlist_items, playlist_id, fields=self.SPOTIFY_PAGE_FIELDS,
+                limit=page_size, offset=offset, additional_types=('track',)
+            )
+
+        first = await fetch_page(0)
+        semaphore = asyncio.Semaphore(self.config.spotify_page_concurrency)
+
+        async def limited(offset):
+            async with semaphore:
+                return await fetch_page(offset)
+
+        pages = [first] + await asyncio.gather(
+            *(limited(offset) for offset in range(page_size, first.get('total') or 0, page_size))
+        )
+
+        tracks = []
+        for page in pages:
+            for item in page.get('items') or []:
+                track = item.get('track')
+                # Локальные файлы и удаленные треки приходят без id
+                if not track or not track.get('id'):
+                    continue
+                tracks.append({
+                    'query': f"{track['name']} {track['artists'][0]['name']}",
+                    'spotify_data': {
+                        'id': track['id'],
+                        'name': track['name'],
+                        'artists': [a['name'] for a in track['artists']],
+                        'duration_ms': track['duration_ms']
+                    }
+                })
+        metrics.observe('spotify_fetch_seconds', time.perf_counter() - started)
+        return tracks
+
+    async def _resolve_spotify_track(self, item):
+        track_id = item['spotify_data']['id']
+        known = self.track_index.get(track_id)
+        if not known:
+            try:
+                res = await self.run_ydl_extract(
+                    f"ytsearch{self.config.spotify_search_results}:{item['query']}", 'search',
+                    caller='spotify_search'
+                )
+            except Exception as e:
+                safe_log_info(f"Ошибка поиска {item['query']}: {e}")
+                return None
+            candidates = [entry for entry in (res or {}).get('entries') or [] if entry and entry.get('url')]
+            if not candidates:
+                return None
+            # max берет первый из равных, так что при равной оценке выигрывает позиция в выдаче
+            entry = max(candidates, key=lambda e: score_search_candidate(e, item['spotify_data']))
+            known = {
+                'title': entry['title'],
+                'original_url': entry.get('original_url') or entry.get('webpage_url') or entry['url'],
+                'duration': entry.get('duration') or 0
+            }
+            self.track_index.put(track_id, known['title'], known['original_url'], known['duration'])
+
+        # Длительность найденного видео: оценщик допускает расхождение с Spotify до 30 секунд.
+        # Старые записи индекса хранят только ссылку, для них остается длительность из Spotify
+        duration = known.get('duration') or item['spotify_data']['duration_ms'] / 1000
+        return Track(known['original_url'], known['title'], duration, track_id)
+
+    async def _resolve_stream(self, page_url, caller='play'):
+        """Извлекает прямой аудио URL для страницы трека: {'url': ..., 'cached': ...}"""
+        local_path = self.audio_cache.get(page_url) if self.audio_cache else None
+        if local_path:
+            metrics.inc('stream_resolve_total', caller=caller, source='audio_cache')
+            return {'url': local_path, 'cached': False, 'local': True}
+
+        stream = self.stream_cache.get(page_url)
+        if stream:
+            metrics.inc('stream_resolve_total', caller=caller, source='stream_cache')
+            return stream
+
+        metrics.inc('stream_resolve_total', caller=caller, source='extract')
+        info = await self.run_ydl_extract(page_url, 'stream', ExtractorPool.PLAY, caller=caller)
+        if not info:
+            return None
+
+        # yt-dlp уже выбрал формат по YoutubeDLSettings.Format
+        selected = info if info.get('url', '').startswith("http") else None
+        if not selected:
+            candidates = [
+                f for f in info.get('formats') or []
+                if f.get('acodec') not in (None, 'none') and f.get('url', '').startswith("http")
+            ]
+            # Предпочитаем Opus: такой поток можно отдать без перекодирования
+            candidates.sort(key=lambda f: (f.get('acodec') != 'opus', f.get('vcodec') not in (None, 'none')))
+            selected = candidates[0] if candidates else None
+        if not selected:
+            return None
+
+        stream = {
+            'url': selected['url'],
+            'cached': False,
+            'acodec': selected.get('acodec'),
+            'ext': selected.get('ext'),
+            # Длительность именно этого медиа: по ней видно, что поток оборвался раньше конца
+            'duration': info.get('duration') or 0
+        }
+        self.stream_cache.put(page_url, stream)
+        return stream
+
+    def ffmpeg_source_options(self, stream, offset=0, gain=None):
+        """Аргументы FFmpegOpusAudio: Opus без фильтров копируется, остальное перекодируется.
+
+        gain - замеренное усиление в дБ: вместо loudnorm ставится volume, а незаметное
+        усиление не ставится вовсе, чтобы не мешать копированию Opus.
+        """
+        filters = self.ffmpeg_filters
+        if gain is not None and self.loudnorm_target:
+            filters, _ = replace_loudnorm(filters, f'volume={gain}dB' if abs(gain) >= 0.5 else None)
+        passthrough = not filters and (stream.get('local') or stream.get('acodec') == 'opus')
+        options = ' '.join(filter(None, ['-vn', self.ffmpeg_output_options, filters]))
+        # Флаги переподключения относятся к http и ломают чтение локального файла
+        before_options = None if stream.get('local') else (self.ffmpeg_before_options or DEFAULT_FFMPEG_BEFORE_OPTIONS)
+        if offset:
+            # -ss перед входом: ffmpeg сразу перематывает источник, а не декодирует начало
+            before_options = ' '.join(filter(None, [f'-ss {offset:.2f}', before_options]))
+        return {
+            'executable': self.config.ffmpeg_path,
+            'before_options': before_options,
+            'options': options,
+            'codec': 'copy' if passthrough else None
+        }
+
     @app_commands.command(name="play", description="Начать воспроизведение плейлиста")
+    @app_commands.guild_only()
     async def play(self, interaction: discord.Interaction, url: str = None):
         await interaction.response.defer()
+        player = self.get_player(interaction.guild_id)
 
-        if self.is_loading:
+        if player.is_loading:
             await interaction.followup.send("⏳ Уже идет загрузка плейлиста, пожалуйста подождите...")
             return
-        if self.is_playing:
+        if player.is_playing:
             await interaction.followup.send("🎵 Уже играет музыка! Используйте /stop чтобы остановить.")
             return
 
-        if not await self.connect_to_voice():
+        if not await self.connect_player(interaction):
             await interaction.followup.send("❌ Ошибка подключения к голосовому каналу")
             return
 
@@ -484,135 +3024,196 @@ class MusicCog(commands.Cog):
                 await interaction.followup.send("⌛ Время вышло, отменено")
                 return
 
-        success = False
-        if "spotify.com" in url:
-            success = await self.load_spotify_playlist(url, interaction)
-        else:
-            success = await self.load_playlist(url, interaction)
+        success = await player._start_loading(url, interaction)
 
         if not success:
             await interaction.followup.send("❌ Не удалось загрузить плейлист")
             return
 
-        await interaction.followup.send("✅ Плейлист загружен, начинаю воспроизведение...")
-        await self.play_next()
+        if player.is_loading:
+            await interaction.followup.send("▶️ Первый трек готов, начинаю воспроизведение, остальные догружаются...")
+        else:
+            await interaction.followup.send("✅ Плейлист загружен, начинаю воспроизведение...")
+        await player.play_next()
 
     @app_commands.command(name="skip", description="Пропустить текущий трек")
+    @app_commands.guild_only()
     async def skip(self, interaction: discord.Interaction):
         await interaction.response.defer()
+        player = self.get_player(interaction.guild_id)
 
-        if not self.is_playing:
+        if not player.is_playing:
             await interaction.followup.send("Ничего не играет")
             return
 
-        async with self._play_lock:
+        async with player._play_lock:
             current_time = datetime.now(timezone.utc).timestamp()
-            if current_time - self.last_skip_time < self.config.skip_cooldown:
+            if current_time - player.last_skip_time < self.config.skip_cooldown:
                 await interaction.followup.send(f"Подождите {self.config.skip_cooldown} сек")
                 return
 
-            self.last_skip_time = current_time
-            self._manual_skip = True
-            await self._increment_position()
-            self.voice_client.stop()
+            player.last_skip_time = current_time
+            player._manual_skip = True
+            await player._increment_position()
+            player._refresh_lookahead(player.current_position)
+            player.voice_client.stop()
             await interaction.followup.send("Пропущено")
 
     @app_commands.command(name="stop", description="Остановить воспроизведение")
+    @app_commands.guild_only()
     async def stop(self, interaction: discord.Interaction):
         await interaction.response.defer()
+        player = self.get_player(interaction.guild_id)
 
         # Полная очистка состояния
-        if self.voice_client:
-            if self.voice_client.is_playing():
-                self.voice_client.stop()
-            await self.voice_client.disconnect(force=True)
-            self.voice_client = None
+        player._leaving = True
+        if player.voice_client:
+            if player.voice_client.is_playing():
+                player.voice_client.stop()
+            await player.voice_client.disconnect(force=True)
+            player.voice_client = None
 
         # Сброс всех переменных состояния
-        self.current_song = None
-        self.full_playlist = []
-        self.current_position = 0
-        self.is_playing = False
-        self._manual_skip = False
-        self.is_loading = False
+        player.clear()
 
         await interaction.followup.send("⏹️ Воспроизведение остановлено и состояние сброшено")
 
     @app_commands.command(name="nowplaying", description="Показать текущий трек")
+    @app_commands.guild_only()
     async def now_playing(self, interaction: discord.Interaction):
         await interaction.response.defer()
-        if not self.current_song:
+        player = self.get_player(interaction.guild_id)
+        if not player.current_song:
             await interaction.followup.send("Ничего не играет")
             return
-        await interaction.followup.send(f"Сейчас: {self.current_song['title']}")
+        await interaction.followup.send(f"Сейчас: {player.current_song.title}")
 
     @app_commands.command(name="playlist", description="Показать текущий плейлист")
+    @app_commands.guild_only()
     async def show_playlist(self, interaction: discord.Interaction):
         await interaction.response.defer()
-        if not self.full_playlist:
+        player = self.get_player(interaction.guild_id)
+        if not player.full_playlist:
             await interaction.followup.send("Пусто")
             return
-        message = ["**Плейлист:**"]
-        for i, song in enumerate(self.full_playlist, start=1):
-            prefix = "▶️ " if i == self.current_position + 1 and self.is_playing else ""
-            message.append(f"{i}. {prefix}{song['title']}")
-        for chunk in [message[i:i + 10] for i in range(0, len(message), 10)]:
-            await interaction.followup.send("\n".join(chunk))
+        # Одно сообщение со страницами вместо сообщения на каждые 10 строк
+        view = PlaylistView(player, interaction.user.id)
+        view.message = await interaction.followup.send(view.render(), view=view, wait=True)
 
     @app_commands.command(name="goto", description="Перейти к треку по номеру")
-    async def goto_track(self, interaction: discord.Interaction, track_number: int):
+    @app_commands.describe(original="Номер в исходном порядке плейлиста, а не в перемешанном")
+    @app_commands.guild_only()
+    async def goto_track(self, interaction: discord.Interaction, track_number: int, original: bool = False):
         await interaction.response.defer()
-        if not self.full_playlist:
+        player = self.get_player(interaction.guild_id)
+        if not player.full_playlist:
             await interaction.followup.send("Пусто")
             return
-        if track_number < 1 or track_number > len(self.full_playlist):
-            await interaction.followup.send(f"Недопустимый номер: 1-{len(self.full_playlist)}")
+        if track_number < 1 or track_number > len(player.full_playlist):
+            await interaction.followup.send(f"Недопустимый номер: 1-{len(player.full_playlist)}")
             return
-        if track_number == self.current_position + 1:
-            await interaction.followup.send(f"Уже играет: {self.full_playlist[self.current_position]['title']}")
+        position = player.full_playlist.position_of(track_number - 1) if original else track_number - 1
+        if position == player.current_position:
+            await interaction.followup.send(f"Уже играет: {player.full_playlist[position].title}")
             return
 
-        async with self._play_lock:
-            self.current_position = track_number - 1
-            self._manual_skip = True
-            if self.is_playing:
-                self.voice_client.stop()
-            else:
-                await self.play_next()
-            await interaction.followup.send(f"Переход: {track_number}")
+        await self._jump(player, position)
+        await interaction.followup.send(f"Переход: {track_number}")
+
+    async def _jump(self, player, position, back=False):
+        """Переключает сессию на позицию воспроизведения position"""
+        async with player._play_lock:
+            player.current_position = position
+            player._going_back = back
+            player._refresh_lookahead(player.current_position)
+            if player.is_playing:
+                player._manual_skip = True
+                player.voice_client.stop()
+        if not player.is_playing:
+            # play_next сам берет _play_lock, поэтому вызываем его вне блокировки
+            await player.play_next()
+
+    @app_commands.command(name="back", description="Вернуться к предыдущему сыгранному треку")
+    @app_commands.guild_only()
+    async def back(self, interaction: discord.Interaction):
+        await interaction.response.defer()
+        player = self.get_player(interaction.guild_id)
+        while player.history:
+            track = player.history.pop()
+            # После обновления плейлиста трека могло не остаться
+            position = next((i for i, candidate in enumerate(player.full_playlist) if candidate.url == track.url), None)
+            if position is not None:
+                await self._jump(player, position, back=True)
+                await interaction.followup.send(f"⏪ Назад: {track.title}")
+                return
+        await interaction.followup.send("История пуста")
+
+    @app_commands.command(name="shuffle", description="Перемешать порядок воспроизведения")
+    @app_commands.guild_only()
+    async def shuffle(self, interaction: discord.Interaction):
+        await interaction.response.defer()
+        player = self.get_player(interaction.guild_id)
+        if not player.full_playlist:
+            await interaction.followup.send("Пусто")
+            return
+        async with player._play_lock:
+            # Текущий трек остается первым, остальные идут после него в случайном порядке
+            current = player.full_playlist.original_index(player.current_position) if player.current_song else None
+            player.full_playlist.shuffle(first=current)
+            player.current_position = 0
+            player._order_changed()
+        await interaction.followup.send("🔀 Порядок перемешан")
+
+    @app_commands.command(name="unshuffle", description="Вернуть исходный порядок плейлиста")
+    @app_commands.guild_only()
+    async def unshuffle(self, interaction: discord.Interaction):
+        await interaction.response.defer()
+        player = self.get_player(interaction.guild_id)
+        if not player.full_playlist.shuffled:
+            await interaction.followup.send("Плейлист и так в исходном порядке")
+            return
+        async with player._play_lock:
+            player.current_position = player.full_playlist.original_index(player.current_position)
+            player.full_playlist.unshuffle()
+            player._order_changed()
+        await interaction.followup.send(f"↩️ Исходный порядок, текущий трек: {player.current_position + 1}")
 
     @app_commands.command(name="leave", description="Покинуть голосовой канал")
+    @app_commands.guild_only()
     async def leave(self, interaction: discord.Interaction):
         await interaction.response.defer()
-        if not self.voice_client:
+        player = self.get_player(interaction.guild_id)
+        if not player.voice_client:
             await interaction.followup.send("Бот не подключен к голосовому каналу")
             return
-        self.reset_state()
-        await self.voice_client.disconnect(force=True)
-        self.voice_client = None
+        player._leaving = True
+        player.reset_state()
+        await player.voice_client.disconnect(force=True)
+        player.voice_client = None
         await interaction.followup.send("✅ Успешно покинул голосовой канал")
 
     @commands.Cog.listener()
     async def on_voice_state_update(self, member, before, after):
         if member == self.bot.user and after.channel is None:
             try:
-                # Только сброс состояния, не пытаемся переподключаться
-                self.voice_client = None
-                self.is_playing = False
-                self.current_song = None
-                safe_log_info("Бот был отключен от голосового канала")
+                # Сессия запоминает место и сама переподключается, если отключение не по команде
+                player = self.get_player(member.guild.id)
+                player.on_disconnected(before.channel)
+                safe_log_info(f"Бот был отключен от голосового канала на сервере {member.guild.id}")
             except Exception as e:
                 safe_log_info(f"Ошибка в on_voice_state_update: {e}")
 
     @app_commands.command(name="random", description="Случайное воспроизведение треков из плейлиста")
+    @app_commands.guild_only()
     async def random(self, interaction: discord.Interaction, url: str = None):
         await interaction.response.defer()
+        player = self.get_player(interaction.guild_id)
 
-        if self.is_loading:
+        if player.is_loading:
             await interaction.followup.send("⏳ Уже идет загрузка, подождите...")
             return
 
-        if not await self.connect_to_voice():
+        if not await self.connect_player(interaction):
             await interaction.followup.send("❌ Ошибка подключения к голосовому каналу")
             return
 
@@ -627,42 +3228,123 @@ class MusicCog(commands.Cog):
                 await interaction.followup.send("❌ Нет доступных плейлистов в конфигурации")
                 return
 
-        # Загружаем плейлист
-        success = False
-        if "spotify.com" in url:
-            success = await self.load_spotify_playlist(url, interaction)
-        else:
-            success = await self.load_playlist(url, interaction)
+        # Загружаем плейлист целиком: перемешивать нужно все треки
+        success = await player._start_loading(url, interaction, wait_full=True)
 
         if not success:
             await interaction.followup.send("❌ Не удалось загрузить плейлист")
             return
 
-        random.shuffle(self.full_playlist)
-        self.current_position = 0
+        player.full_playlist.shuffle()
+        player.current_position = 0
+        player._refresh_lookahead(player.current_position)
 
         await interaction.followup.send("🔀 Случайное воспроизведение включено!")
-        await self.play_next()
-
-
-class MusicBot(commands.Bot):
-    def __init__(self, config):
+        await player.play_next()
+
+    @app_commands.command(name="stats", description="Показать метрики производительности бота")
+    @app_commands.guild_only()
+    @app_commands.default_permissions(administrator=True)
+    async def stats(self, interaction: discord.Interaction):
+        await interaction.response.defer(ephemeral=True)
+
+        def timing(name, title):
+            lines = []
+            for labels, (count, mean) in sorted(metrics.histogram_summary(name).items()):
+                suffix = ", ".join(f"{k}={v}" for k, v in labels)
+                lines.append(f"{title}{f' ({suffix})' if suffix else ''}: {count} шт., среднее {mean * 1000:.0f} мс")
+            return lines
+
+        uptime = datetime.now(timezone.utc) - self.bot_start_time
+        message = [
+            "**Статистика:**",
+            f"Аптайм: {str(uptime).split('.')[0]}",
+            f"Активных сессий: {sum(1 for p in self.players.values() if p.is_playing)} из {len(self.players)}",
+            f"Очередь извлечения: play={self.extractors.queue_depth(ExtractorPool.PLAY)}, "
+            f"bulk={self.extractors.queue_depth(ExtractorPool.BULK)}",
+        ]
+        if self.warmup_status:
+            message.append(f"Прогрев: {self.warmup_status}")
+        for name, (hits, misses) in self._cache_hits().items():
+            total = hits + misses
+            message.append(f"Кеш {name}: {hits}/{total} попаданий ({hits / total * 100 if total else 0:.0f}%)")
+        message += timing('ydl_extract_seconds', "Извлечение")
+        message += timing('ffmpeg_first_packet_seconds', "ffmpeg до первого пакета")
+        message += timing('track_gap_seconds', "Пауза между треками")
+        message += timing('play_next_lock_wait_seconds', "Ожидание блокировки play_next")
+        await interaction.followup.send("\n".join(message)[:2000], ephemeral=True)
+
+
+class MusicBotMixin:
+    """Общая логика бота для обычного и шардированного режимов"""
+
+    def __init__(self, config, **kwargs):
+        self._startup_started = self._startup_mark = time.perf_counter()
+        self.startup_timings = {}
         intents = discord.Intents.default()
         intents.voice_states = True
         intents.message_content = True
-        super().__init__(command_prefix=config.command_prefix, intents=intents, help_command=None)
+        super().__init__(command_prefix=config.command_prefix, intents=intents, help_command=None, **kwargs)
         self.config = config
 
+    def _mark_startup(self, phase):
+        """Запоминает длительность этапа запуска с момента предыдущей отметки"""
+        now = time.perf_counter()
+        self.startup_timings[phase] = round(now - self._startup_mark, 3)
+        self._startup_mark = now
+
+    def _command_tree_hash(self):
+        commands_data = [command.to_dict(self.tree) for command in self.tree.get_commands()]
+        payload = json.dumps([self.application_id, commands_data], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    async def sync_commands(self):
+        """Синхронизирует слэш-команды, только если дерево изменилось с прошлого запуска"""
+        hash_file = Path(self.config.cache_dir) / "command_tree.sha256"
+        tree_hash = self._command_tree_hash()
+        try:
+            if hash_file.read_text(encoding='utf-8').strip() == tree_hash:
+                safe_log_info("Команды не изменились, синхронизация пропущена")
+                return False
+        except OSError:
+            pass
+        await self.tree.sync()
+        try:
+            hash_file.parent.mkdir(parents=True, exist_ok=True)
+            hash_file.write_text(tree_hash, encoding='utf-8')
+        except OSError as e:
+            safe_log_info(f"Не удалось сохранить хеш команд: {e}")
+        return True
+
     async def setup_hook(self):
+        self._mark_startup('login')
         await self.add_cog(MusicCog(self, self.config))
-        await self.tree.sync()
+        self._mark_startup('cog_init')
+        await self.sync_commands()
+        self._mark_startup('command_sync')
 
     async def on_ready(self):
-        safe_log_info(f'Бот готов: {self.user.name}')
+        safe_log_info(f'Бот готов: {self.user.name}, серверов: {len(self.guilds)}')
+        if 'gateway' not in self.startup_timings:
+            self._mark_startup('gateway')
+            total = round(time.perf_counter() - self._startup_started, 3)
+            breakdown = ", ".join(f"{phase} {seconds} с" for phase, seconds in self.startup_timings.items())
+            safe_log_info(f"Запуск за {total} с: {breakdown}", startup=self.startup_timings, startup_total=total)
         music_cog = self.get_cog("MusicCog")
-        music_cog.reset_state()
-        if self.config.voice_channel_id:
-            await music_cog.connect_to_voice()
+        music_cog.start_warm_up()
+        for player in music_cog.players.values():
+            player.reset_state()
+        channel = self.get_channel(self.config.voice_channel_id) if self.config.voice_channel_id else None
+        if isinstance(channel, discord.VoiceChannel):
+            await music_cog.get_player(channel.guild.id).connect_to_voice(channel)
+
+
+class MusicBot(MusicBotMixin, commands.Bot):
+    pass
+
+
+class ShardedMusicBot(MusicBotMixin, commands.AutoShardedBot):
+    """Один процесс на много серверов: discord.py сам распределяет шарды"""
 
 
 def load_config():
@@ -679,16 +3361,21 @@ def main():
 
     try:
         config = load_config()
-        bot = MusicBot(config)
+        setup_logging(max_bytes=config.log_max_bytes, backup_count=config.log_backup_count)
+        if config.sharded:
+            bot = ShardedMusicBot(config, shard_count=config.shard_count)
+        else:
+            bot = MusicBot(config)
 
         # Установка обработчика сигналов для корректного завершения
         import signal
         signal.signal(signal.SIGINT, lambda s, f: bot.close())
         signal.signal(signal.SIGTERM, lambda s, f: bot.close())
 
-        bot.run(config.token)
+        # Логи discord.py идут через общую очередь, а не отдельным синхронным обработчиком
+        bot.run(config.token, log_handler=None)
     except Exception as e:
-        safe_log_info(f"Критическая ошибка: {str(e)}")
+        safe_log_info(f"Критическая ошибка: {str(e)}", exc_info=True)
 
 
 if __name__ == "__main__":